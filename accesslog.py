@@ -0,0 +1,117 @@
+import json
+import os
+import queue
+import threading
+import time
+
+from models import DroppingQueue
+
+
+class AccessLog:
+    def __init__(
+        self,
+        path,
+        buffer_size=10000,
+        batch_size=500,
+        flush_interval=1.0,
+        max_bytes=None,
+        rotate_interval=None,
+        backup_count=5,
+    ):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.rotate_interval = rotate_interval
+        self.backup_count = backup_count
+        self._queue = DroppingQueue(buffer_size)
+        self._stop = threading.Event()
+        self._file = None
+        self._opened_at = None
+        self._thread = threading.Thread(
+            target=self._run, name="access-log", daemon=True
+        )
+        self._thread.start()
+
+    @property
+    def dropped(self):
+        return self._queue.dropped
+
+    def log(self, **record):
+        # never block the request path, a full buffer means the record is lost
+        self._queue.offer(record)
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._write(self._next_batch())
+        # write whatever was buffered before close() was called
+        batch = self._next_batch(block=False)
+        while batch:
+            self._write(batch)
+            batch = self._next_batch(block=False)
+        if self._file:
+            self._file.close()
+
+    def _next_batch(self, block=True):
+        batch = []
+        try:
+            if block:
+                batch.append(self._queue.get(timeout=self.flush_interval))
+            else:
+                batch.append(self._queue.get_nowait())
+        except queue.Empty:
+            return batch
+        # collect up to batch_size records, waiting at most flush_interval
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                if block and remaining > 0:
+                    batch.append(self._queue.get(timeout=remaining))
+                else:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _write(self, batch):
+        if not batch:
+            return
+        data = "".join(
+            json.dumps(record, separators=(",", ":")) + "\n" for record in batch
+        )
+        if self._file is None:
+            self._open()
+        elif self._should_rotate(len(data)):
+            self._rotate()
+        self._file.write(data)
+        self._file.flush()
+
+    def _open(self):
+        self._file = open(self.path, "a")
+        self._opened_at = time.monotonic()
+
+    def _should_rotate(self, size):
+        position = self._file.tell()
+        if self.max_bytes and position and position + size > self.max_bytes:
+            return True
+        if self.rotate_interval:
+            return time.monotonic() - self._opened_at >= self.rotate_interval
+        return False
+
+    def _rotate(self):
+        self._file.close()
+        # shift access.log.1 -> access.log.2 and so on, dropping the oldest
+        for index in range(self.backup_count - 1, 0, -1):
+            source = f"{self.path}.{index}"
+            if os.path.exists(source):
+                os.replace(source, f"{self.path}.{index + 1}")
+        if self.backup_count:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self._open()
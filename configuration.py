@@ -0,0 +1,305 @@
+import os
+import pickle
+import sys
+
+from utils import load_configuration
+
+# bump whenever the layout of a compiled snapshot changes
+SNAPSHOT_VERSION = 2
+
+ALGORITHMS = [None, "random", "least", "weight", "round"]
+RULES = ["header_rules", "param_rules", "post_data_rules", "cookie_rules"]
+# the keyword arguments AccessLog accepts
+ACCESS_LOG = {
+    "path",
+    "buffer_size",
+    "batch_size",
+    "flush_interval",
+    "max_bytes",
+    "rotate_interval",
+    "backup_count",
+}
+LISTEN = {"host", "port", "drain_timeout"}
+
+
+class ConfigurationError(Exception):
+    def __init__(self, errors):
+        self.errors = errors
+        super().__init__("\n".join(errors))
+
+
+def mapping(where, value, errors):
+    # wrongly typed sections are reported, and checked as if they were empty
+    if isinstance(value, dict):
+        return value
+    errors.append(f"{where} must be a mapping")
+    return {}
+
+
+def sequence(where, value, errors):
+    if isinstance(value, list):
+        return value
+    errors.append(f"{where} must be a list")
+    return []
+
+
+def is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def validate_servers(where, servers, errors):
+    if not isinstance(servers, list):
+        errors.append(f"{where}: servers must be a list")
+        return
+    for server in servers:
+        if isinstance(server, dict):
+            if "endpoint" not in server:
+                errors.append(f"{where}: server {server} has no endpoint")
+            if server.get("scheme", "http") not in ("http", "https"):
+                errors.append(f"{where}: unknown scheme {server['scheme']!r}")
+            if not isinstance(server.get("priority", 0), int):
+                errors.append(f"{where}: priority must be an integer")
+        elif not isinstance(server, str):
+            errors.append(f"{where}: server {server!r} must be a string or mapping")
+
+
+def validate_balancing(where, entry, errors):
+    # checks shared by hosts, paths and groups
+    algo = entry.get("algo")
+    if algo not in ALGORITHMS:
+        errors.append(f"{where}: unknown algo {algo!r}")
+    if "servers" not in entry and "discovery" not in entry and "groups" not in entry:
+        errors.append(f"{where}: needs servers, discovery or groups")
+    servers = entry.get("servers", [])
+    validate_servers(where, servers, errors)
+    if algo == "weight":
+        weights = entry.get("weights")
+        if not isinstance(weights, list) or not weights:
+            errors.append(f"{where}: algo weight needs a list of weights")
+        elif isinstance(servers, list) and len(weights) != len(servers):
+            errors.append(f"{where}: {len(weights)} weights for {len(servers)} servers")
+        elif not all(is_number(weight) for weight in weights):
+            errors.append(f"{where}: weights must be numbers")
+    if entry.get("slow_start") is not None:
+        slow_start = mapping(f"{where}: slow_start", entry["slow_start"], errors)
+        window = slow_start.get("window", 30)
+        if not is_number(window) or window <= 0:
+            errors.append(f"{where}: slow_start window must be positive")
+        floor = slow_start.get("floor", 0.1)
+        if not is_number(floor) or not 0 < floor <= 1:
+            errors.append(f"{where}: slow_start floor must be in (0, 1]")
+        if slow_start.get("mode", "linear") not in ("linear", "exponential"):
+            errors.append(f"{where}: unknown slow_start mode")
+    failover = mapping(f"{where}: failover", entry.get("failover", {}), errors)
+    threshold = failover.get("threshold", 0.7)
+    if not is_number(threshold) or not 0 <= threshold <= 1:
+        errors.append(f"{where}: failover threshold must be in [0, 1]")
+    if "discovery" in entry:
+        discovery = mapping(f"{where}: discovery", entry["discovery"], errors)
+        if "dns" not in discovery and "file" not in discovery:
+            errors.append(f"{where}: discovery needs dns or file")
+
+
+def validate_rules(where, entry, errors):
+    for rules in RULES:
+        instructions = mapping(f"{where}: {rules}", entry.get(rules, {}), errors)
+        for instruction, values in instructions.items():
+            if instruction not in ("add", "remove"):
+                errors.append(f"{where}: {rules} has unknown {instruction!r}")
+            elif not isinstance(values, dict):
+                errors.append(f"{where}: {rules} {instruction} must be a mapping")
+    if "rewrite_rules" in entry:
+        rewrite_rules = entry["rewrite_rules"]
+        if not isinstance(rewrite_rules, dict):
+            errors.append(f"{where}: rewrite_rules must be a mapping")
+        elif not isinstance(rewrite_rules.get("replace"), dict):
+            errors.append(f"{where}: rewrite_rules needs a replace mapping")
+    firewall_rules = mapping(
+        f"{where}: firewall_rules", entry.get("firewall_rules", {}), errors
+    )
+    for rules in ("ip_reject", "path_reject"):
+        if not isinstance(firewall_rules.get(rules, []), list):
+            errors.append(f"{where}: firewall_rules {rules} must be a list")
+    header_reject = firewall_rules.get("header_reject", {})
+    if not isinstance(header_reject, dict):
+        errors.append(f"{where}: firewall_rules header_reject must be a mapping")
+    elif not all(isinstance(values, list) for values in header_reject.values()):
+        errors.append(f"{where}: firewall_rules header_reject needs lists of values")
+
+
+def validate_groups(where, entry, errors):
+    groups = [
+        mapping(f"{where}: group", group, errors)
+        for group in sequence(f"{where}: groups", entry["groups"], errors)
+    ]
+    names = [group.get("name") for group in groups]
+    if not all(isinstance(name, str) for name in names):
+        errors.append(f"{where}: groups need unique names")
+        names = [name for name in names if isinstance(name, str)]
+    elif len(set(names)) != len(names):
+        errors.append(f"{where}: groups need unique names")
+    for group in groups:
+        validate_balancing(f"{where} group {group.get('name')}", group, errors)
+        if "groups" in group:
+            errors.append(f"{where} group {group.get('name')}: groups can't be nested")
+    split = mapping(f"{where}: split", entry.get("split", {}), errors)
+    for name, percentage in split.items():
+        if name not in names:
+            errors.append(f"{where}: split refers to unknown group {name!r}")
+        if not is_number(percentage) or percentage < 0:
+            errors.append(f"{where}: split for {name!r} must be a positive number")
+    if split and all(is_number(value) for value in split.values()):
+        if not sum(split.values()):
+            errors.append(f"{where}: split adds up to nothing")
+    for rule in sequence(f"{where}: match", entry.get("match", []), errors):
+        rule = mapping(f"{where}: match rule", rule, errors)
+        if rule.get("group") not in names:
+            errors.append(
+                f"{where}: match refers to unknown group {rule.get('group')!r}"
+            )
+        if "header" not in rule and "cookie" not in rule:
+            errors.append(f"{where}: match rules need a header or cookie")
+
+
+def validate_section(name, section, keys, errors):
+    # top level sections are passed on as keyword arguments or read by key
+    section = mapping(name, section, errors)
+    for key in section:
+        if key not in keys:
+            errors.append(f"{name}: unknown setting {key!r}")
+    return section
+
+
+def validate_settings(config, errors):
+    if "access_log" in config:
+        access_log = validate_section(
+            "access_log", config["access_log"], ACCESS_LOG, errors
+        )
+        if access_log and "path" not in access_log:
+            errors.append("access_log: needs a path")
+    listen = validate_section("listen", config.get("listen", {}), LISTEN, errors)
+    if not isinstance(listen.get("host", ""), str):
+        errors.append("listen: host must be a string")
+    for key in ("port", "drain_timeout"):
+        if not is_number(listen.get(key, 0)):
+            errors.append(f"listen: {key} must be a number")
+    admin = validate_section("admin", config.get("admin", {}), {"allow"}, errors)
+    if not isinstance(admin.get("allow", []), list):
+        errors.append("admin: allow must be a list")
+    validate_section("profiling", config.get("profiling", {}), {"stages"}, errors)
+    if not isinstance(config.get("zone", ""), str):
+        errors.append("zone must be a string")
+    if "tls" in config:
+        tls = mapping("tls", config["tls"], errors)
+        if not {"cert", "key"} <= set(tls):
+            errors.append("tls: needs cert and key")
+
+
+def validate_configuration(config):
+    errors = []
+    if not isinstance(config, dict):
+        raise ConfigurationError(["configuration must be a mapping"])
+    validate_settings(config, errors)
+    hosts = set()
+    for entry in sequence("hosts", config.get("hosts", []), errors):
+        if not isinstance(entry, dict):
+            errors.append(f"hosts: entry {entry!r} must be a mapping")
+            continue
+        host = entry.get("host")
+        where = f"host {host}"
+        if not host or not isinstance(host, str):
+            errors.append("hosts: entry without a host")
+        elif host in hosts:
+            errors.append(f"{where}: defined more than once")
+        else:
+            hosts.add(host)
+        validate_balancing(where, entry, errors)
+        validate_rules(where, entry, errors)
+        if "groups" in entry:
+            validate_groups(where, entry, errors)
+        if "mirror" in entry:
+            mirror = mapping(f"{where}: mirror", entry["mirror"], errors)
+            validate_servers(f"{where} mirror", mirror.get("servers"), errors)
+            percentage = mirror.get("percentage", 100)
+            if not is_number(percentage) or not 0 <= percentage <= 100:
+                errors.append(f"{where}: mirror percentage must be in [0, 100]")
+        if "tls" in entry:
+            tls = mapping(f"{where}: tls", entry["tls"], errors)
+            if not {"cert", "key"} <= set(tls):
+                errors.append(f"{where}: tls needs cert and key")
+    paths = set()
+    for entry in sequence("paths", config.get("paths", []), errors):
+        if not isinstance(entry, dict):
+            errors.append(f"paths: entry {entry!r} must be a mapping")
+            continue
+        path = entry.get("path")
+        where = f"path {path}"
+        if not isinstance(path, str) or not path.startswith("/"):
+            errors.append(f"{where}: path must start with /")
+        elif path in paths:
+            errors.append(f"{where}: defined more than once")
+        else:
+            paths.add(path)
+        validate_balancing(where, entry, errors)
+    if errors:
+        raise ConfigurationError(errors)
+    return config
+
+
+def snapshot_path(path):
+    return f"{path}.snapshot"
+
+
+def source_stamp(path):
+    # deploys often keep the file's original mtime, so the snapshot has to
+    # match the yaml exactly rather than just be newer than it
+    stat = os.stat(path)
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def compile_configuration(path):
+    # stamped before reading, a yaml that changes meanwhile won't match later
+    stamp = source_stamp(path)
+    config = validate_configuration(load_configuration(path))
+    compiled = {
+        "version": SNAPSHOT_VERSION,
+        "source": stamp,
+        "config": config,
+        # lookup tables so routing doesn't scan every entry per request
+        "hosts": {entry["host"]: entry for entry in config.get("hosts", [])},
+        "paths": {entry["path"]: entry for entry in config.get("paths", [])},
+    }
+    # write next to the yaml and swap in, a reader never sees half a file
+    snapshot = snapshot_path(path)
+    try:
+        with open(f"{snapshot}.tmp", "wb") as snapshot_file:
+            pickle.dump(compiled, snapshot_file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(f"{snapshot}.tmp", snapshot)
+    except OSError:
+        pass
+    return compiled
+
+
+def load_compiled(path):
+    # the snapshot is only trusted while it was compiled from this very yaml
+    try:
+        with open(snapshot_path(path), "rb") as snapshot_file:
+            compiled = pickle.load(snapshot_file)
+        if (
+            isinstance(compiled, dict)
+            and compiled.get("version") == SNAPSHOT_VERSION
+            and compiled.get("source") == source_stamp(path)
+        ):
+            return compiled
+    except Exception:
+        # a snapshot that can't be read in any way is just rebuilt from the yaml
+        pass
+    return compile_configuration(path)
+
+
+if __name__ == "__main__":
+    try:
+        compile_configuration(sys.argv[1] if len(sys.argv) > 1 else "loadbalancer.yaml")
+    except ConfigurationError as error:
+        print(error, file=sys.stderr)
+        sys.exit(1)
@@ -0,0 +1,166 @@
+import json
+import logging
+import os
+import socket
+import threading
+import time
+
+import yaml
+
+from utils import group_key, server_from_config
+
+try:
+    import dns.resolver
+except ImportError:  # SRV records and real TTLs need dnspython
+    dns = None
+
+logger = logging.getLogger(__name__)
+
+
+def resolve(name, record):
+    # returns ([(host, port or None), ...], ttl or None)
+    if dns is not None:
+        answer = dns.resolver.resolve(name, record)
+        if record == "SRV":
+            targets = [(str(r.target).rstrip("."), r.port) for r in answer]
+        else:
+            targets = [(r.address, None) for r in answer]
+        return targets, answer.rrset.ttl
+    if record == "SRV":
+        raise RuntimeError("SRV discovery needs dnspython installed")
+    addresses = socket.getaddrinfo(name, None, socket.AF_INET, socket.SOCK_STREAM)
+    return sorted({(address[4][0], None) for address in addresses}), None
+
+
+class DnsSource:
+    def __init__(self, name, port=80, record="A", ttl=30, resolver=resolve):
+        self.name = name
+        self.port = port
+        self.record = record
+        # used when the resolver reports no TTL and for retries
+        self.interval = ttl
+        self.resolver = resolver
+
+    def refresh(self):
+        targets, ttl = self.resolver(self.name, self.record)
+        endpoints = [f"{host}:{port or self.port}" for host, port in targets]
+        return endpoints, ttl or self.interval
+
+    def reset(self):
+        pass
+
+
+class FileSource:
+    def __init__(self, path, interval=5):
+        self.path = path
+        self.interval = interval
+        self.mtime = None
+
+    def refresh(self):
+        mtime = os.stat(self.path).st_mtime
+        if mtime == self.mtime:
+            return None, self.interval
+        with open(self.path) as endpoints_file:
+            if self.path.endswith(".json"):
+                endpoints = json.load(endpoints_file)
+            else:
+                endpoints = yaml.safe_load(endpoints_file)
+        if isinstance(endpoints, dict):
+            endpoints = endpoints.get("servers", [])
+        if not isinstance(endpoints, list):
+            raise ValueError(f"{self.path} does not hold a list of servers")
+        self.mtime = mtime
+        return endpoints, self.interval
+
+    def reset(self):
+        # read the file again next time even if it has not changed
+        self.mtime = None
+
+
+def source_from_config(entry):
+    if "dns" in entry:
+        return DnsSource(
+            entry["dns"],
+            port=entry.get("port", 80),
+            record=entry.get("record", "A"),
+            ttl=entry.get("ttl", 30),
+        )
+    return FileSource(entry["file"], interval=entry.get("interval", 5))
+
+
+def sync(pool, endpoints):
+    # add and remove members in place, servers that stay keep their
+    # health and open connection counts
+    wanted = {}
+    for entry in endpoints:
+        try:
+            server = server_from_config(entry)
+        except (KeyError, TypeError, AttributeError):
+            logger.warning("skipping discovered server %r", entry)
+            continue
+        wanted[server.endpoint] = server
+    gone = [server for server in pool if server.endpoint not in wanted]
+    if gone:
+        pool.remove(*gone)
+    current = {server.endpoint for server in pool}
+    new = [server for endpoint, server in wanted.items() if endpoint not in current]
+    if new:
+        pool.add(*new)
+
+
+class Discovery:
+    def __init__(self, register, sources):
+        # sources maps a register key to the source for its servers
+        self.register = register
+        self.sources = sources
+        self.due = {key: 0 for key in sources}
+        self._stop = threading.Event()
+        self._thread = None
+
+    @classmethod
+    def from_config(cls, config, register):
+        sources = {}
+        for entry in config.get("hosts", []):
+            if "discovery" in entry:
+                sources[entry["host"]] = source_from_config(entry["discovery"])
+            for group in entry.get("groups", []):
+                if "discovery" in group:
+                    key = group_key(entry["host"], group["name"])
+                    sources[key] = source_from_config(group["discovery"])
+        for entry in config.get("paths", []):
+            if "discovery" in entry:
+                sources[entry["path"]] = source_from_config(entry["discovery"])
+        if not sources:
+            return None
+        return cls(register, sources)
+
+    def refresh(self, now=None):
+        now = time.monotonic() if now is None else now
+        for key, source in self.sources.items():
+            if self.due[key] > now:
+                continue
+            try:
+                endpoints, ttl = source.refresh()
+                if endpoints is not None:
+                    sync(self.register[key], endpoints)
+            except Exception:
+                # a failed lookup keeps the last known servers until the next try
+                logger.exception("discovery for %s failed", key)
+                source.reset()
+                ttl = source.interval
+            self.due[key] = now + ttl
+        return min(self.due.values())
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="discovery", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+
+    def _run(self):
+        while not self._stop.is_set():
+            next_due = self.refresh()
+            self._stop.wait(max(next_due - time.monotonic(), 0.1))
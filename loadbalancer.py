@@ -1,86 +1,269 @@
-import requests
-from flask import Flask, request
+import atexit
+import threading
+import time
+from urllib.parse import urlencode
 
-from utils import (get_healthy_server, healthcheck, load_configuration,
-                   process_firewall_rules_flag, process_rewrite_rules,
-                   process_rules, transform_backends_from_config)
+from flask import Blueprint, Flask, g, jsonify, request
+
+from accesslog import AccessLog
+from configuration import load_compiled
+from discovery import Discovery
+from mirror import mirrors_from_config
+from profiling import SamplingProfiler, StageProfiler
+from proxy import is_event_stream, is_upgrade, stream, tunnel
+from serving import InFlight, serve
+from tls import CertificateStore
+from utils import (apply_rewrite_rules, apply_rules, drain_server,
+                   firewall_allows, get_healthy_server, group_key, healthcheck,
+                   selectors_from_config, transform_backends_from_config)
 
 loadbalancer = Flask(__name__)
 
-config = load_configuration("loadbalancer.yaml")
+compiled = load_compiled("loadbalancer.yaml")
+config = compiled["config"]
+hosts = compiled["hosts"]
+paths = compiled["paths"]
 register = transform_backends_from_config(config)
+selectors = selectors_from_config(config)
+discovery = Discovery.from_config(config, register)
+if discovery:
+    discovery.start()
+access_log = AccessLog(**config["access_log"]) if "access_log" in config else None
+if access_log:
+    atexit.register(access_log.close)
+profiler = StageProfiler(config.get("profiling", {}).get("stages", False))
+sampler = SamplingProfiler()
+certificates = CertificateStore.from_config(config)
+mirrors = mirrors_from_config(config)
+in_flight = InFlight()
+
+
+@loadbalancer.before_request
+def start_timer():
+    in_flight.enter()
+    g.start = time.perf_counter()
+    g.backend = None
+    g.algo = None
+    g.upstream_time = None
+
+
+@loadbalancer.after_request
+def log_access(response):
+    if access_log:
+        access_log.log(
+            time=time.time(),
+            host=request.headers.get("Host"),
+            path=request.path,
+            backend=g.backend,
+            algo=g.algo,
+            status=response.status_code,
+            bytes=response.calculate_content_length(),
+            upstream_time=g.upstream_time,
+            total_time=time.perf_counter() - g.start,
+        )
+    return response
+
+
+@loadbalancer.teardown_request
+def finish_request(exc):
+    in_flight.exit()
 
 
 @loadbalancer.route("/")
 @loadbalancer.route("/<path>")
+# werkzeug only matches websocket upgrades against rules that allow them
+@loadbalancer.route("/", websocket=True)
+@loadbalancer.route("/<path>", websocket=True)
 def router(path="/"):
-    updated_register = healthcheck(register)
+    with profiler.stage("healthcheck"):
+        updated_register = healthcheck(register)
     host_header = request.headers["Host"]
     header_dictionary = {k: v for k, v in request.headers.items()}
 
-    if not process_firewall_rules_flag(
-        config,
-        host_header,
-        request.environ["REMOTE_ADDR"],
-        f"/{path}",
-        header_dictionary,
-    ):
-        return "Forbidden", 403
-
-    for entry in config["hosts"]:
-        try:
-            algo = entry["algo"]
-        except KeyError:
-            pass
+    # the host entry is looked up once and handed to every rule below
+    entry = hosts.get(host_header)
+    if entry:
+        with profiler.stage("firewall"):
+            allowed = firewall_allows(
+                entry,
+                request.environ["REMOTE_ADDR"],
+                f"/{path}",
+                header_dictionary,
+            )
+        if not allowed:
+            return "Forbidden", 403
+        algo = entry.get("algo")
+        weights = None
         if algo == "weight":
-            try:
-                weights = [weights for weights in entry["weights"]]
-            except KeyError:
-                weights = None
-        else:
-            weights = None
-
-        if host_header == entry["host"]:
+            weights = list(entry.get("weights", [])) or None
+        key = entry["host"]
+        slow_start = entry.get("slow_start")
+        selector = selectors.get(host_header)
+        if selector:
+            group = selector.select(request.headers, request.cookies)
+            key = group_key(entry["host"], group["name"])
+            algo = group.get("algo")
+            weights = list(group.get("weights", [])) or None
+            slow_start = group.get("slow_start", slow_start)
+        with profiler.stage("select"):
             healthy_server = get_healthy_server(
-                entry["host"], updated_register, algo, weights
+                key, updated_register, algo, weights, slow_start
             )
-            if not healthy_server:
-                return "No backend servers available.", 503
-            headers = process_rules(
-                config,
-                host_header,
-                {k: v for k, v in request.headers.items()},
-                "header",
+        g.algo = algo or "random"
+        if not healthy_server:
+            return "No backend servers available.", 503
+        g.backend = healthy_server.endpoint
+        with profiler.stage("header_rules"):
+            headers = apply_rules(
+                entry, {k: v for k, v in request.headers.items()}, "header"
             )
-            params = process_rules(
-                config, host_header, {k: v for k, v in request.args.items()}, "param"
+        with profiler.stage("param_rules"):
+            params = apply_rules(
+                entry, {k: v for k, v in request.args.items()}, "param"
             )
-            post_data = process_rules(
-                config, host_header, {k: v for k, v in request.data}, "post_data"
-            )
-            cookies = process_rules(
-                config, host_header, {k: v for k, v in request.cookies}, "cookie"
-            )
-            rewrite_path = ""
-            if path == "v1":
-                rewrite_path = process_rewrite_rules(config, host_header, path)
-            response = requests.get(
-                f"http://{healthy_server.endpoint}/{rewrite_path}",
-                headers=headers,
-                params=params,
-                data=post_data,
-                cookies=cookies,
+        with profiler.stage("post_data_rules"):
+            post_data = apply_rules(entry, {k: v for k, v in request.data}, "post_data")
+        with profiler.stage("cookie_rules"):
+            cookies = apply_rules(entry, {k: v for k, v in request.cookies}, "cookie")
+        rewrite_path = ""
+        if path == "v1":
+            rewrite_path = apply_rewrite_rules(entry, path)
+        upgrade = is_upgrade(request.headers)
+        long_lived = is_event_stream(request.headers)
+        mirror = mirrors.get(host_header)
+        # a replayed upgrade or event stream would only tie up a mirror worker
+        if mirror and not upgrade and not long_lived and mirror.sample():
+            mirror.submit(rewrite_path, headers, params, post_data, cookies)
+        idle_timeout = entry.get("idle_timeout", 60)
+        if upgrade:
+            client = request.environ.get("werkzeug.socket")
+            if client is None:
+                return "Upgrade not supported", 501
+            target = "/" + (rewrite_path or path).lstrip("/")
+            if params:
+                target += "?" + urlencode(params)
+            return tunnel(healthy_server, client, target, headers, idle_timeout)
+        upstream_start = time.perf_counter()
+        healthy_server.open_connections += 1
+        try:
+            with profiler.stage("upstream"):
+                response = healthy_server.session.get(
+                    healthy_server.url(rewrite_path),
+                    headers=headers,
+                    params=params,
+                    data=post_data,
+                    cookies=cookies,
+                    stream=long_lived,
+                    timeout=idle_timeout if long_lived else None,
+                )
+        finally:
+            healthy_server.open_connections -= 1
+        g.upstream_time = time.perf_counter() - upstream_start
+        if long_lived:
+            return stream(healthy_server, response, in_flight)
+        return response.content, response.status_code
+
+    entry = paths.get("/" + path)
+    if entry:
+        with profiler.stage("select"):
+            healthy_server = get_healthy_server(
+                entry["path"], register, slow_start=entry.get("slow_start")
             )
-            return response.content, response.status_code
-
-    for entry in config["paths"]:
-        if ("/" + path) == entry["path"]:
-            healthy_server = get_healthy_server(entry["path"], register)
-            if not healthy_server:
-                return "No backend servers available", 503
-            healthy_server.open_connections += 1
-            response = requests.get(f"http://{healthy_server.endpoint}")
+        g.algo = "random"
+        if not healthy_server:
+            return "No backend servers available", 503
+        g.backend = healthy_server.endpoint
+        healthy_server.open_connections += 1
+        upstream_start = time.perf_counter()
+        try:
+            with profiler.stage("upstream"):
+                response = healthy_server.session.get(healthy_server.url())
+        finally:
             healthy_server.open_connections -= 1
-            return response.content, response.status_code
+        g.upstream_time = time.perf_counter() - upstream_start
+        return response.content, response.status_code
 
     return "Not Found", 404
+
+
+admin = Blueprint("admin", __name__, url_prefix="/admin")
+
+
+@admin.before_request
+def restrict_admin():
+    allowed = config.get("admin", {}).get("allow", ["127.0.0.1"])
+    if request.environ["REMOTE_ADDR"] not in allowed:
+        return "Forbidden", 403
+
+
+@admin.route("/stages", methods=["GET"])
+def stage_timings():
+    return jsonify(enabled=profiler.enabled, stages=profiler.to_dict())
+
+
+@admin.route("/stages", methods=["POST"])
+def enable_stage_timings():
+    profiler.enabled = True
+    return jsonify(enabled=profiler.enabled)
+
+
+@admin.route("/stages", methods=["DELETE"])
+def disable_stage_timings():
+    profiler.enabled = False
+    profiler.reset()
+    return jsonify(enabled=profiler.enabled)
+
+
+@admin.route("/profile", methods=["POST"])
+def start_profile():
+    seconds = request.args.get("seconds", 30, type=float)
+    if not sampler.start(seconds):
+        return "Profiler already running", 409
+    return jsonify(running=True, seconds=seconds), 202
+
+
+@admin.route("/profile", methods=["DELETE"])
+def stop_profile():
+    sampler.stop()
+    return jsonify(running=False)
+
+
+@admin.route("/profile", methods=["GET"])
+def profile_stacks():
+    return sampler.folded(), 200, {"Content-Type": "text/plain"}
+
+
+@admin.route("/tls/reload", methods=["POST"])
+def reload_certificates():
+    if not certificates:
+        return "TLS not configured", 404
+    certificates.reload()
+    return jsonify(hosts=sorted(certificates.contexts))
+
+
+@admin.route("/drain", methods=["POST"])
+def drain():
+    pool = register.get(request.args.get("key"))
+    server = pool.find(request.args.get("endpoint")) if pool else None
+    if not server:
+        return "Not Found", 404
+    timeout = request.args.get("timeout", 30, type=float)
+    threading.Thread(
+        target=drain_server, args=(pool, server, timeout), daemon=True
+    ).start()
+    return jsonify(draining=server.endpoint), 202
+
+
+loadbalancer.register_blueprint(admin)
+
+
+if __name__ == "__main__":
+    listen = config.get("listen", {})
+    serve(
+        loadbalancer,
+        listen.get("host", "0.0.0.0"),
+        listen.get("port", 5000),
+        in_flight,
+        ssl_context=certificates.server_context() if certificates else None,
+        drain_timeout=listen.get("drain_timeout", 30),
+    )
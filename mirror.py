@@ -0,0 +1,82 @@
+import random
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from models import DroppingQueue, ServerPool
+from utils import server_from_config
+
+
+class Mirror:
+    def __init__(self, servers, percentage=100, queue_size=100, workers=2, timeout=5):
+        self.pool = ServerPool(servers)
+        self.percentage = percentage
+        self.timeout = timeout
+        self._queue = DroppingQueue(queue_size)
+        # shadow traffic gets its own connections so it never holds up a
+        # connection the primary backends need
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._workers = [
+            threading.Thread(target=self._run, name="mirror", daemon=True)
+            for _ in range(workers)
+        ]
+        for worker in self._workers:
+            worker.start()
+
+    @classmethod
+    def from_config(cls, entry):
+        return cls(
+            [server_from_config(server) for server in entry["servers"]],
+            percentage=entry.get("percentage", 100),
+            queue_size=entry.get("queue_size", 100),
+            workers=entry.get("workers", 2),
+            timeout=entry.get("timeout", 5),
+        )
+
+    @property
+    def dropped(self):
+        return self._queue.dropped
+
+    def sample(self):
+        return random.random() * 100 < self.percentage
+
+    def submit(self, path, headers, params, data, cookies):
+        # fire and forget, a full queue means this copy is not sent
+        self._queue.offer((path, headers, params, data, cookies))
+
+    def close(self):
+        for _ in self._workers:
+            self._queue.put(None)
+        for worker in self._workers:
+            worker.join()
+
+    def _run(self):
+        while True:
+            request = self._queue.get()
+            if request is None:
+                return
+            path, headers, params, data, cookies = request
+            try:
+                server = random.choice(self.pool.healthy)
+                self.session.get(
+                    server.url(path),
+                    headers=headers,
+                    params=params,
+                    data=data,
+                    cookies=cookies,
+                    timeout=self.timeout,
+                )
+            except (IndexError, requests.exceptions.RequestException):
+                pass
+
+
+def mirrors_from_config(config):
+    return {
+        entry["host"]: Mirror.from_config(entry["mirror"])
+        for entry in config.get("hosts", [])
+        if "mirror" in entry
+    }
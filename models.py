@@ -1,18 +1,112 @@
+import bisect
+import contextlib
+import queue
+import random
+import threading
+import time
+
 import requests
 
+from tls import TLSAdapter, client_context
+
 
 class Server:
-    def __init__(self, endpoint, path="/healthcheck"):
+    __slots__ = (
+        "endpoint",
+        "path",
+        "_healthy",
+        "healthy_since",
+        "timeout",
+        "scheme",
+        "verify",
+        "zone",
+        "priority",
+        "open_connections",
+        "draining",
+        "pools",
+        "_session",
+    )
+
+    def __init__(
+        self,
+        endpoint,
+        path="/healthcheck",
+        scheme="http://",
+        verify=True,
+        zone=None,
+        priority=0,
+    ):
         self.endpoint = endpoint
         self.path = path
-        self.healthy = True
+        self._healthy = True
+        # when the server last became healthy, slow start ramps up from here
+        self.healthy_since = time.monotonic()
         self.timeout = 1
-        self.scheme = "http://"
+        self.scheme = scheme
+        self.verify = verify
+        self.zone = zone
+        # lower numbers are preferred, higher tiers only take spill over
+        self.priority = priority
         self.open_connections = 0
+        self.draining = False
+        # every pool this server belongs to, told about health transitions
+        self.pools = []
+        self._session = None
+
+    @property
+    def healthy(self):
+        return self._healthy
+
+    @healthy.setter
+    def healthy(self, healthy):
+        # request threads run health checks concurrently, a transition and the
+        # rebuild it causes must not interleave with another one
+        with self.locked():
+            if healthy == self._healthy:
+                return
+            self._healthy = healthy
+            if healthy:
+                self.healthy_since = time.monotonic()
+            for pool in self.pools:
+                pool.refresh()
+
+    def locked(self):
+        # the locks of every pool holding this server, always taken in the
+        # same order so two servers sharing pools can't deadlock
+        stack = contextlib.ExitStack()
+        for pool in sorted(self.pools, key=id):
+            stack.enter_context(pool.lock)
+        return stack
+
+    def drain(self):
+        # stop new assignments, requests already on this server carry on
+        self.draining = True
+        for pool in self.pools:
+            pool.refresh()
+
+    @property
+    def session(self):
+        # created on first use so idle backends don't each hold a session,
+        # afterwards it keeps the backend's connections pooled between requests
+        if self._session is None:
+            session = requests.Session()
+            if self.scheme == "https://":
+                session.verify = self.verify
+                session.mount("https://", TLSAdapter(client_context(self.verify)))
+            self._session = session
+        return self._session
+
+    @property
+    def ssl_context(self):
+        # shared with the session so tunnels resume the same TLS sessions
+        return self.session.get_adapter("https://").ssl_context
+
+    def url(self, path=""):
+        return f"{self.scheme}{self.endpoint}/{path}"
 
     def healthcheck_and_update_status(self):
         try:
-            response = requests.get(
+            response = self.session.get(
                 self.scheme + self.endpoint + self.path, timeout=self.timeout
             )
             if response.ok:
@@ -29,3 +123,162 @@ class Server:
 
     def __repr__(self):
         return f"<Server: {self.endpoint} {self.healthy} {self.timeout}>"
+
+
+class ServerPool:
+    __slots__ = ("servers", "healthy", "newest", "zone", "threshold", "lock")
+
+    def __init__(self, servers=(), zone=None, threshold=0.7):
+        self.servers = []
+        self.healthy = []
+        self.newest = None
+        # the balancer's own zone, and the share of a tier or zone that has to
+        # be healthy before traffic stops spilling over beyond it
+        self.zone = zone
+        self.threshold = threshold
+        # reentrant, a health transition holds it while refreshing the pool
+        self.lock = threading.RLock()
+        self.add(*servers)
+
+    # both take any number of servers and refresh once, so building or
+    # syncing a large pool stays linear
+    def add(self, *servers):
+        with self.lock:
+            for server in servers:
+                self.servers.append(server)
+                server.pools.append(self)
+            self.refresh()
+
+    def remove(self, *servers):
+        # servers that already left, say drained twice or dropped by discovery
+        # while draining, are ignored
+        with self.lock:
+            removed = {server.endpoint for server in servers}
+            self.servers = [
+                server for server in self.servers if server.endpoint not in removed
+            ]
+            for server in servers:
+                if self in server.pools:
+                    server.pools.remove(self)
+            self.refresh()
+
+    def refresh(self):
+        # build a new list instead of editing in place, so a request that is
+        # still selecting from the old one never sees it change underneath it
+        with self.lock:
+            healthy = self.preferred(
+                [
+                    server
+                    for server in self.servers
+                    if server.healthy and not server.draining
+                ]
+            )
+            # lets slow start skip pools where nothing is ramping up any more
+            self.newest = max(
+                (server.healthy_since for server in healthy), default=None
+            )
+            self.healthy = healthy
+
+    def preferred(self, available):
+        priorities = sorted({server.priority for server in self.servers})
+        if len(priorities) < 2 and self.zone is None:
+            return available
+        # take the best tier, and the next ones while the healthy share of the
+        # tiers taken so far is below the threshold
+        candidates = []
+        total = healthy = 0
+        for priority in priorities:
+            tier = [server for server in self.servers if server.priority == priority]
+            tier_available = [
+                server for server in available if server.priority == priority
+            ]
+            candidates.extend(self.local(tier, tier_available))
+            total += len(tier)
+            healthy += len(tier_available)
+            # never settle on tiers with nothing healthy, even at threshold 0
+            if healthy and healthy >= self.threshold * total:
+                break
+        return candidates
+
+    def local(self, tier, tier_available):
+        # within a tier, stay in the local zone unless too little of it is left
+        if self.zone is None:
+            return tier_available
+        local = [server for server in tier if server.zone == self.zone]
+        local_available = [
+            server for server in tier_available if server.zone == self.zone
+        ]
+        if local_available and len(local_available) >= self.threshold * len(local):
+            return local_available
+        return tier_available
+
+    def __iter__(self):
+        return iter(self.servers)
+
+    def __len__(self):
+        return len(self.servers)
+
+    def __getitem__(self, index):
+        return self.servers[index]
+
+    def find(self, endpoint):
+        for server in self.servers:
+            if server.endpoint == endpoint:
+                return server
+        return None
+
+    def __repr__(self):
+        return f"<ServerPool: {len(self.healthy)}/{len(self.servers)} healthy>"
+
+
+class DroppingQueue(queue.Queue):
+    # for work that must never hold up a request, a full queue loses the item
+    def __init__(self, maxsize):
+        super().__init__(maxsize=maxsize)
+        self.dropped = 0
+
+    def offer(self, item):
+        try:
+            self.put_nowait(item)
+        except queue.Full:
+            self.dropped += 1
+
+
+class GroupSelector:
+    __slots__ = ("groups", "headers", "cookies", "choices", "thresholds")
+
+    def __init__(self, groups, split=None, match=()):
+        self.groups = {group["name"]: group for group in groups}
+        # match rules become flat tuples so selection is a short scan
+        self.headers = [
+            (rule["header"], rule.get("value"), self.groups[rule["group"]])
+            for rule in match
+            if "header" in rule
+        ]
+        self.cookies = [
+            (rule["cookie"], rule.get("value"), self.groups[rule["group"]])
+            for rule in match
+            if "cookie" in rule
+        ]
+        # cumulative percentages, a random point is placed with bisect
+        split = split or {groups[0]["name"]: 100}
+        self.choices = []
+        self.thresholds = []
+        total = 0
+        for name, percentage in split.items():
+            if percentage > 0:
+                total += percentage
+                self.choices.append(self.groups[name])
+                self.thresholds.append(total)
+
+    def select(self, headers, cookies):
+        for name, value, group in self.headers:
+            found = headers.get(name)
+            if found is not None and (value is None or found == value):
+                return group
+        for name, value, group in self.cookies:
+            found = cookies.get(name)
+            if found is not None and (value is None or found == value):
+                return group
+        point = random.random() * self.thresholds[-1]
+        return self.choices[bisect.bisect_right(self.thresholds, point)]
@@ -0,0 +1,144 @@
+import bisect
+import collections
+import sys
+import threading
+import time
+
+# upper bounds in seconds, doubling from 10us to roughly 10s
+BUCKETS = [0.00001 * 2**i for i in range(21)]
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        # the last slot counts everything above the largest bound
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, value):
+        # no lock: a lost increment under contention is cheaper than locking
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+
+    def quantile(self, q):
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return self.buckets[min(index, len(self.buckets) - 1)]
+        return self.buckets[-1]
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "total": self.total,
+            "p50": self.quantile(0.5),
+            "p99": self.quantile(0.99),
+            "buckets": {
+                str(bound): count
+                for bound, count in zip(self.buckets + ["+Inf"], self.counts)
+                if count
+            },
+        }
+
+
+class _Stage:
+    __slots__ = ("histogram", "start")
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start)
+        return False
+
+
+class _NullStage:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+NULL_STAGE = _NullStage()
+
+
+class StageProfiler:
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.stages = collections.defaultdict(Histogram)
+
+    def stage(self, name):
+        if not self.enabled:
+            return NULL_STAGE
+        return _Stage(self.stages[name])
+
+    def reset(self):
+        self.stages = collections.defaultdict(Histogram)
+
+    def to_dict(self):
+        return {name: histogram.to_dict() for name, histogram in self.stages.items()}
+
+
+def fold_stack(frame):
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append(f"{code.co_name} ({code.co_filename}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return ";".join(reversed(stack))
+
+
+class SamplingProfiler:
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.samples = collections.Counter()
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, duration):
+        if self.running:
+            return False
+        self.samples = collections.Counter()
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run, args=(duration,), name="sampling-profiler", daemon=True
+        )
+        self._thread.start()
+        return True
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+
+    def _run(self, duration):
+        own_thread = threading.get_ident()
+        deadline = time.monotonic() + duration
+        while time.monotonic() < deadline and not self._stop.is_set():
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id != own_thread:
+                    self.samples[fold_stack(frame)] += 1
+            self._stop.wait(self.interval)
+
+    def folded(self):
+        # one "frame;frame;frame count" line per stack, as flamegraph.pl expects
+        return "".join(
+            f"{stack} {count}\n" for stack, count in self.samples.most_common()
+        )
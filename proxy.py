@@ -0,0 +1,119 @@
+import select
+import socket
+import ssl
+from urllib.parse import urlsplit
+
+from flask import Response
+
+BUFFER_SIZE = 65536
+
+
+def is_upgrade(headers):
+    connection = headers.get("Connection", "")
+    return "upgrade" in connection.lower() and "Upgrade" in headers
+
+
+def is_event_stream(headers):
+    return "text/event-stream" in headers.get("Accept", "")
+
+
+def host_and_port(endpoint, default_port):
+    # endpoints may leave out the port, like the http path allows
+    address = urlsplit(f"//{endpoint}")
+    return address.hostname, address.port or default_port
+
+
+def open_upstream(server, timeout):
+    default_port = 443 if server.scheme == "https://" else 80
+    host, port = host_and_port(server.endpoint, default_port)
+    sock = socket.create_connection((host, port), timeout)
+    if server.scheme == "https://":
+        sock = server.ssl_context.wrap_socket(sock, server_hostname=host)
+    return sock
+
+
+def upgrade_request(server, target, headers):
+    headers = dict(headers)
+    headers.setdefault("Host", server.endpoint)
+    lines = [f"GET {target} HTTP/1.1"]
+    lines.extend(f"{key}: {value}" for key, value in headers.items())
+    return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+
+def pending(sock):
+    return isinstance(sock, ssl.SSLSocket) and sock.pending()
+
+
+def splice(client, upstream, idle_timeout, buffer_size=BUFFER_SIZE):
+    # one buffer reused in both directions, sent through a memoryview so the
+    # bytes are never copied into new objects
+    buffer = bytearray(buffer_size)
+    view = memoryview(buffer)
+    peers = {client: upstream, upstream: client}
+    sockets = [client, upstream]
+    while True:
+        # TLS sockets can hold decrypted bytes select() knows nothing about
+        readable = [sock for sock in sockets if pending(sock)]
+        if not readable:
+            readable, _, _ = select.select(sockets, [], [], idle_timeout)
+            if not readable:
+                return "idle"
+        for sock in readable:
+            try:
+                received = sock.recv_into(buffer)
+                if not received:
+                    return "closed"
+                peers[sock].sendall(view[:received])
+            except OSError:
+                return "closed"
+
+
+class TunnelResponse(Response):
+    # the client socket was spliced to the backend and is finished with, so
+    # there is nothing left to write; werkzeug treats ConnectionError as a
+    # dropped connection and closes it quietly
+    def __call__(self, environ, start_response):
+        raise ConnectionError("connection handed over to tunnel")
+
+
+def tunnel(server, client, target, headers, idle_timeout):
+    try:
+        upstream = open_upstream(server, idle_timeout)
+    except (OSError, ValueError):
+        return "Bad Gateway", 502
+    server.open_connections += 1
+    try:
+        upstream.sendall(upgrade_request(server, target, headers))
+        splice(client, upstream, idle_timeout)
+    finally:
+        upstream.close()
+        server.open_connections -= 1
+    # end the client connection too, otherwise werkzeug waits on it for a
+    # keep-alive request that never comes
+    try:
+        client.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+    return TunnelResponse(status=101)
+
+
+def stream(server, response, in_flight=None):
+    # the backend counts as busy until the client has stopped reading, and so
+    # does the request: flask tears it down before the body is sent
+    server.open_connections += 1
+    if in_flight:
+        in_flight.enter()
+    proxied = Response(
+        response.iter_content(chunk_size=None),
+        status=response.status_code,
+        content_type=response.headers.get("Content-Type"),
+    )
+
+    @proxied.call_on_close
+    def release():
+        response.close()
+        server.open_connections -= 1
+        if in_flight:
+            in_flight.exit()
+
+    return proxied
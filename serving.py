@@ -0,0 +1,67 @@
+import os
+import signal
+import subprocess
+import sys
+import threading
+
+from werkzeug.serving import make_server
+
+# the listening socket a replacement process inherits from the one before it
+LISTEN_FD = "LOADBALANCER_FD"
+
+
+class InFlight:
+    def __init__(self):
+        self.count = 0
+        self._condition = threading.Condition()
+
+    def enter(self):
+        with self._condition:
+            self.count += 1
+
+    def exit(self):
+        with self._condition:
+            self.count -= 1
+            if not self.count:
+                self._condition.notify_all()
+
+    def wait(self, timeout=None):
+        with self._condition:
+            return self._condition.wait_for(lambda: not self.count, timeout)
+
+
+def replace_process(fd):
+    # start a copy of this process that serves from the same socket
+    env = dict(os.environ, **{LISTEN_FD: str(fd)})
+    return subprocess.Popen([sys.executable] + sys.argv, pass_fds=(fd,), env=env)
+
+
+def serve(app, host, port, in_flight, ssl_context=None, drain_timeout=30):
+    fd = os.environ.get(LISTEN_FD)
+    server = make_server(
+        host,
+        port,
+        app,
+        threaded=True,
+        ssl_context=ssl_context,
+        fd=int(fd) if fd else None,
+    )
+
+    def stop_accepting():
+        # shutdown() waits for serve_forever() to return, so it cannot be
+        # called from the signal handler running on the same thread
+        threading.Thread(target=server.shutdown).start()
+
+    def upgrade(signum, frame):
+        replace_process(server.fileno())
+        stop_accepting()
+
+    def stop(signum, frame):
+        stop_accepting()
+
+    signal.signal(signal.SIGUSR2, upgrade)
+    signal.signal(signal.SIGTERM, stop)
+    # serve_forever() closes the listening socket itself when it returns
+    server.serve_forever()
+    # new connections now go to the replacement, let ours finish first
+    in_flight.wait(drain_timeout)
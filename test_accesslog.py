@@ -0,0 +1,32 @@
+import json
+
+from accesslog import AccessLog
+
+
+def read_records(path):
+    with open(path) as log_file:
+        return [json.loads(line) for line in log_file]
+
+
+def test_access_log_writes_records(tmp_path):
+    path = tmp_path / "access.log"
+    access_log = AccessLog(str(path), flush_interval=0.01)
+    access_log.log(host="www.anthrax.com", path="/", status=200)
+    access_log.log(host="www.metallica.com", path="/v1", status=503)
+    access_log.close()
+    assert read_records(path) == [
+        {"host": "www.anthrax.com", "path": "/", "status": 200},
+        {"host": "www.metallica.com", "path": "/v1", "status": 503},
+    ]
+
+
+def test_access_log_rotates_by_size(tmp_path):
+    path = tmp_path / "access.log"
+    access_log = AccessLog(str(path), batch_size=1, max_bytes=20, backup_count=2)
+    for status in [200, 201, 202, 203]:
+        access_log.log(status=status)
+    access_log.close()
+    assert read_records(path) == [{"status": 203}]
+    assert read_records(f"{path}.1") == [{"status": 202}]
+    assert read_records(f"{path}.2") == [{"status": 201}]
+    assert not (tmp_path / "access.log.3").exists()
@@ -0,0 +1,219 @@
+import os
+import pickle
+
+import pytest
+import yaml
+
+import configuration
+from configuration import (ConfigurationError, compile_configuration,
+                           load_compiled, snapshot_path, validate_configuration)
+from utils import load_configuration
+
+
+def errors_for(text):
+    with pytest.raises(ConfigurationError) as error:
+        validate_configuration(yaml.safe_load(text))
+    return error.value.errors
+
+
+def test_validate_shipped_configuration():
+    config = load_configuration("loadbalancer.yaml")
+    assert validate_configuration(config) is config
+
+
+def test_validate_rewrite_rules_without_replace():
+    errors = errors_for(
+        """
+        hosts:
+          - host: www.anthrax.com
+            rewrite_rules:
+              v1: v2
+            servers:
+              - localhost:8081
+    """
+    )
+    assert errors == ["host www.anthrax.com: rewrite_rules needs a replace mapping"]
+
+
+def test_validate_mismatched_weights():
+    errors = errors_for(
+        """
+        hosts:
+          - host: www.metallica.com
+            algo: weight
+            weights:
+              - 1
+              - 10
+            servers:
+              - localhost:9081
+              - localhost:9082
+              - localhost:8888
+    """
+    )
+    assert errors == ["host www.metallica.com: 2 weights for 3 servers"]
+
+
+def test_validate_cross_references():
+    errors = errors_for(
+        """
+        hosts:
+          - host: www.megadeth.com
+            algo: fastest
+            groups:
+              - name: stable
+                servers:
+                  - localhost:8081
+            split:
+              stable: 90
+              canary: 10
+            match:
+              - header: X-Internal-User
+                group: canary
+          - host: www.megadeth.com
+            servers:
+              - localhost:8082
+        paths:
+          - path: megadeth
+    """
+    )
+    assert errors == [
+        "host www.megadeth.com: unknown algo 'fastest'",
+        "host www.megadeth.com: split refers to unknown group 'canary'",
+        "host www.megadeth.com: match refers to unknown group 'canary'",
+        "host www.megadeth.com: defined more than once",
+        "path megadeth: path must start with /",
+        "path megadeth: needs servers, discovery or groups",
+    ]
+
+
+def test_validate_nested_groups():
+    errors = errors_for(
+        """
+        hosts:
+          - host: www.anthrax.com
+            groups:
+              - name: stable
+                groups:
+                  - name: inner
+                    servers:
+                      - localhost:8081
+    """
+    )
+    assert errors == ["host www.anthrax.com group stable: groups can't be nested"]
+
+
+def test_validate_wrongly_typed_sections():
+    errors = errors_for(
+        """
+        hosts:
+          - host: www.anthrax.com
+            header_rules:
+              - x
+            rewrite_rules:
+              - v1
+            slow_start: 10
+            servers:
+              - localhost:8081
+    """
+    )
+    assert errors == [
+        "host www.anthrax.com: slow_start must be a mapping",
+        "host www.anthrax.com: header_rules must be a mapping",
+        "host www.anthrax.com: rewrite_rules must be a mapping",
+    ]
+
+
+def test_validate_top_level_settings():
+    errors = errors_for(
+        """
+        access_log:
+          path: access.log
+          flush_every: 1
+        listen:
+          port: http
+        admin:
+          allow: 127.0.0.1
+        profiling: true
+    """
+    )
+    assert errors == [
+        "access_log: unknown setting 'flush_every'",
+        "listen: port must be a number",
+        "admin: allow must be a list",
+        "profiling must be a mapping",
+    ]
+
+
+@pytest.fixture
+def config_path(tmp_path):
+    path = tmp_path / "loadbalancer.yaml"
+    path.write_text(
+        "hosts:\n"
+        "  - host: www.anthrax.com\n"
+        "    servers:\n"
+        "      - localhost:8081\n"
+        "paths:\n"
+        "  - path: /anthrax\n"
+        "    servers:\n"
+        "      - localhost:8081\n"
+    )
+    yield str(path)
+
+
+def test_compile_configuration(config_path):
+    compiled = compile_configuration(config_path)
+    assert os.path.exists(snapshot_path(config_path))
+    assert compiled["hosts"]["www.anthrax.com"] is compiled["config"]["hosts"][0]
+    assert compiled["paths"]["/anthrax"] is compiled["config"]["paths"][0]
+
+
+def test_load_compiled_uses_snapshot(config_path, monkeypatch):
+    compiled = compile_configuration(config_path)
+
+    def parse_yaml(path):
+        raise AssertionError("snapshot should have been used")
+
+    monkeypatch.setattr(configuration, "load_configuration", parse_yaml)
+    assert load_compiled(config_path) == compiled
+
+
+def test_load_compiled_recompiles_stale_snapshot(config_path):
+    compile_configuration(config_path)
+    with open(config_path, "a") as config_file:
+        config_file.write("  - path: /slayer\n")
+        config_file.write("    servers:\n")
+        config_file.write("      - localhost:1111\n")
+    snapshot_mtime = os.stat(snapshot_path(config_path)).st_mtime
+    os.utime(config_path, (snapshot_mtime + 1, snapshot_mtime + 1))
+    compiled = load_compiled(config_path)
+    assert list(compiled["paths"]) == ["/anthrax", "/slayer"]
+
+
+def test_load_compiled_recompiles_yaml_older_than_snapshot(config_path):
+    compile_configuration(config_path)
+    with open(config_path, "w") as config_file:
+        config_file.write("hosts:\n")
+        config_file.write("  - host: www.slayer.com\n")
+        config_file.write("    servers:\n")
+        config_file.write("      - localhost:1111\n")
+    # deployed with its original mtime, long before the snapshot was written
+    os.utime(config_path, (2000, 2000))
+    compiled = load_compiled(config_path)
+    assert list(compiled["hosts"]) == ["www.slayer.com"]
+
+
+def test_load_compiled_rejects_invalid(config_path):
+    with open(config_path, "a") as config_file:
+        config_file.write("  - path: /slayer\n")
+    with pytest.raises(ConfigurationError):
+        load_compiled(config_path)
+
+
+@pytest.mark.parametrize(
+    "payload", [b"not a pickle", pickle.dumps(["not", "a", "dict"]), b"\x80\x05K"]
+)
+def test_load_compiled_recompiles_unreadable_snapshot(config_path, payload):
+    with open(snapshot_path(config_path), "wb") as snapshot_file:
+        snapshot_file.write(payload)
+    compiled = load_compiled(config_path)
+    assert list(compiled["hosts"]) == ["www.anthrax.com"]
@@ -0,0 +1,144 @@
+import json
+
+import yaml
+
+from discovery import Discovery, DnsSource, FileSource, source_from_config, sync
+from models import Server, ServerPool
+from utils import transform_backends_from_config
+
+
+class StubResolver:
+    def __init__(self, answers):
+        self.answers = answers
+        self.lookups = []
+
+    def __call__(self, name, record):
+        self.lookups.append((name, record))
+        return self.answers[(name, record)]
+
+
+def test_dns_source_a_records():
+    resolver = StubResolver(
+        {("anthrax.internal", "A"): ([("10.0.0.1", None), ("10.0.0.2", None)], 10)}
+    )
+    source = DnsSource("anthrax.internal", port=8081, resolver=resolver)
+    assert source.refresh() == (["10.0.0.1:8081", "10.0.0.2:8081"], 10)
+
+
+def test_dns_source_srv_records_default_ttl():
+    resolver = StubResolver(
+        {("_http._tcp.slayer.internal", "SRV"): ([("slayer1", 1111)], None)}
+    )
+    source = DnsSource(
+        "_http._tcp.slayer.internal", record="SRV", ttl=30, resolver=resolver
+    )
+    assert source.refresh() == (["slayer1:1111"], 30)
+
+
+def test_file_source(tmp_path):
+    path = tmp_path / "endpoints.json"
+    path.write_text(json.dumps(["localhost:8081", "localhost:8082"]))
+    source = FileSource(str(path), interval=5)
+    assert source.refresh() == (["localhost:8081", "localhost:8082"], 5)
+    assert source.refresh() == (None, 5)
+
+
+def test_file_source_yaml(tmp_path):
+    path = tmp_path / "endpoints.yaml"
+    path.write_text("servers:\n  - localhost:9081\n")
+    assert FileSource(str(path)).refresh() == (["localhost:9081"], 5)
+
+
+def test_source_from_config():
+    source = source_from_config({"dns": "anthrax.internal", "port": 8081})
+    assert isinstance(source, DnsSource)
+    assert source.port == 8081
+    source = source_from_config({"file": "endpoints.yaml"})
+    assert isinstance(source, FileSource)
+
+
+def test_sync_keeps_existing_servers():
+    kept = Server("localhost:8081")
+    kept.open_connections = 3
+    removed = Server("localhost:8082")
+    pool = ServerPool([kept, removed])
+    sync(pool, ["localhost:8081", "localhost:8083"])
+    assert list(pool) == [kept, Server("localhost:8083")]
+    assert pool[0] is kept
+    assert pool[0].open_connections == 3
+    assert pool.healthy == [kept, Server("localhost:8083")]
+
+
+def test_discovery_refresh_respects_ttl():
+    config = yaml.safe_load("""
+        hosts:
+          - host: www.anthrax.com
+            discovery:
+              dns: anthrax.internal
+              port: 8081
+    """)
+    register = {"www.anthrax.com": ServerPool()}
+    discovery = Discovery.from_config(config, register)
+    resolver = StubResolver({("anthrax.internal", "A"): ([("10.0.0.1", None)], 10)})
+    discovery.sources["www.anthrax.com"].resolver = resolver
+    assert discovery.refresh(now=100) == 110
+    assert list(register["www.anthrax.com"]) == [Server("10.0.0.1:8081")]
+    resolver.answers[("anthrax.internal", "A")] = ([("10.0.0.2", None)], 10)
+    discovery.refresh(now=105)
+    assert len(resolver.lookups) == 1
+    discovery.refresh(now=110)
+    assert list(register["www.anthrax.com"]) == [Server("10.0.0.2:8081")]
+
+
+def test_discovery_fills_group_pools(tmp_path):
+    path = tmp_path / "canary.yaml"
+    path.write_text("servers:\n  - localhost:8082\n")
+    config = yaml.safe_load(f"""
+        hosts:
+          - host: www.anthrax.com
+            groups:
+              - name: stable
+                servers:
+                  - localhost:8081
+              - name: canary
+                discovery:
+                  file: {path}
+    """)
+    register = transform_backends_from_config(config)
+    discovery = Discovery.from_config(config, register)
+    assert list(discovery.sources) == ["www.anthrax.com#canary"]
+    discovery.refresh(now=0)
+    assert list(register["www.anthrax.com#canary"]) == [Server("localhost:8082")]
+
+
+def test_discovery_keeps_servers_on_failure():
+    def failing_resolver(name, record):
+        raise OSError("no answer")
+
+    pool = ServerPool([Server("localhost:8081")])
+    source = DnsSource("anthrax.internal", ttl=15, resolver=failing_resolver)
+    discovery = Discovery({"www.anthrax.com": pool}, {"www.anthrax.com": source})
+    assert discovery.refresh(now=0) == 15
+    assert list(pool) == [Server("localhost:8081")]
+
+
+def test_discovery_recovers_from_malformed_file(tmp_path):
+    path = tmp_path / "endpoints.yaml"
+    path.write_text("servers:\n  - localhost:8082\n  - zone: a\n")
+    pool = ServerPool([Server("localhost:8081")])
+    source = FileSource(str(path), interval=5)
+    discovery = Discovery({"www.anthrax.com": pool}, {"www.anthrax.com": source})
+    discovery.refresh(now=0)
+    # the entry without an endpoint is skipped, the rest still syncs
+    assert list(pool) == [Server("localhost:8082")]
+    path.write_text("not a list\n")
+    assert discovery.refresh(now=5) == 10
+    assert list(pool) == [Server("localhost:8082")]
+    assert source.mtime is None
+    path.write_text("servers:\n  - localhost:8083\n")
+    discovery.refresh(now=10)
+    assert list(pool) == [Server("localhost:8083")]
+
+
+def test_discovery_not_configured():
+    assert Discovery.from_config({"hosts": []}, {}) is None
@@ -1,8 +1,11 @@
 import json
+import time
 
 import pytest
+import responses
 
-from loadbalancer import loadbalancer
+from loadbalancer import loadbalancer, mirrors, register
+from models import Server, ServerPool
 
 
 @pytest.fixture()
@@ -133,3 +136,76 @@ def test_firewall_header_accept(client):
         "/", headers={"Host": "www.metallica.com", "User-Agent": "Safe App"}
     )
     assert result.status_code == 200
+
+
+def test_admin_stage_timings(client):
+    client.post("/admin/stages")
+    client.get("/", headers={"Host": "www.slayer.com"})
+    result = client.get("/admin/stages")
+    data = json.loads(result.data.decode())
+    assert data["enabled"]
+    assert data["stages"]["healthcheck"]["count"] >= 1
+    assert data["stages"]["select"]["count"] >= 1
+    client.delete("/admin/stages")
+    data = json.loads(client.get("/admin/stages").data.decode())
+    assert data == {"enabled": False, "stages": {}}
+
+
+def test_admin_reject(client):
+    result = client.get("/admin/stages", environ_base={"REMOTE_ADDR": "10.192.0.1"})
+    assert result.status_code == 403
+
+
+def test_admin_drain(client):
+    draining = Server("localhost:7777")
+    register["www.slayer.com"].add(draining)
+    result = client.post(
+        "/admin/drain",
+        query_string={"key": "www.slayer.com", "endpoint": "localhost:7777"},
+    )
+    assert result.status_code == 202
+    deadline = time.monotonic() + 5
+    while register["www.slayer.com"].find("localhost:7777"):
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_admin_drain_not_found(client):
+    result = client.post(
+        "/admin/drain",
+        query_string={"key": "www.slayer.com", "endpoint": "localhost:7778"},
+    )
+    assert result.status_code == 404
+
+
+class RecordingMirror:
+    def __init__(self):
+        self.submitted = []
+
+    def sample(self):
+        return True
+
+    def submit(self, *request):
+        self.submitted.append(request)
+
+
+@responses.activate
+def test_mirror_skips_upgrades_and_event_streams(client, monkeypatch):
+    monkeypatch.setattr("loadbalancer.healthcheck", lambda register: register)
+    pool = ServerPool([Server("localhost:7081")])
+    monkeypatch.setitem(register, "www.slayer.com", pool)
+    mirror = RecordingMirror()
+    monkeypatch.setitem(mirrors, "www.slayer.com", mirror)
+    responses.add(responses.GET, "http://localhost:7081/", body="data: hi\n\n")
+    client.get("/", headers={"Host": "www.slayer.com"})
+    assert len(mirror.submitted) == 1
+    client.get("/", headers={"Host": "www.slayer.com", "Accept": "text/event-stream"})
+    client.get(
+        "/",
+        headers={
+            "Host": "www.slayer.com",
+            "Connection": "Upgrade",
+            "Upgrade": "websocket",
+        },
+    )
+    assert len(mirror.submitted) == 1
@@ -0,0 +1,56 @@
+import responses
+import yaml
+
+from mirror import Mirror, mirrors_from_config
+from models import Server
+
+
+@responses.activate
+def test_mirror_sends_copy():
+    responses.add(responses.GET, "http://localhost:7081/v2", status=200)
+    mirror = Mirror([Server("localhost:7081")], workers=1)
+    mirror.submit("v2", {"MyCustomHeader": "Test"}, {"MyCustomParam": "Test"}, {}, {})
+    mirror.close()
+    assert len(responses.calls) == 1
+    request = responses.calls[0].request
+    assert request.url == "http://localhost:7081/v2?MyCustomParam=Test"
+    assert request.headers["MyCustomHeader"] == "Test"
+
+
+@responses.activate
+def test_mirror_ignores_failures():
+    responses.add(responses.GET, "http://localhost:7081/", status=500)
+    mirror = Mirror([Server("localhost:7081"), Server("localhost:7082")], workers=1)
+    mirror.submit("", {}, {}, {}, {})
+    mirror.close()
+    assert mirror.dropped == 0
+
+
+def test_mirror_sample():
+    always = Mirror([], percentage=100, workers=1)
+    never = Mirror([], percentage=0, workers=1)
+    assert always.sample()
+    assert not never.sample()
+    always.close()
+    never.close()
+
+
+def test_mirrors_from_config():
+    config = yaml.safe_load("""
+        hosts:
+          - host: www.anthrax.com
+            mirror:
+              percentage: 10
+              queue_size: 50
+              servers:
+                - localhost:7081
+            servers:
+              - localhost:8081
+          - host: www.metallica.com
+            servers:
+              - localhost:9081
+    """)
+    mirrors = mirrors_from_config(config)
+    assert list(mirrors) == ["www.anthrax.com"]
+    assert mirrors["www.anthrax.com"].percentage == 10
+    assert list(mirrors["www.anthrax.com"].pool) == [Server("localhost:7081")]
@@ -1,7 +1,10 @@
+import threading
+import time
+
 import pytest
 import responses
 
-from models import Server
+from models import DroppingQueue, GroupSelector, Server, ServerPool
 
 
 @pytest.fixture
@@ -32,3 +35,230 @@ def test_server_equal(server):
 def test_server_not_equal(server):
     another = Server("localhost:5555")
     assert server == another
+
+
+def test_server_url(server):
+    assert server.url() == "http://localhost:5555/"
+    assert server.url("v2") == "http://localhost:5555/v2"
+
+
+@responses.activate
+def test_server_https_healthcheck():
+    server = Server("localhost:5555", scheme="https://")
+    responses.add(responses.GET, "https://localhost:5555/healthcheck", status=200)
+    server.healthcheck_and_update_status()
+    assert server.healthy
+    assert server.url() == "https://localhost:5555/"
+
+
+def test_server_ssl_context_is_shared():
+    server = Server("localhost:5555", scheme="https://")
+    assert server.ssl_context is server.ssl_context
+
+
+def test_server_slots(server):
+    assert not hasattr(server, "__dict__")
+
+
+def test_server_pool_tracks_health():
+    backend1 = Server("localhost:8081")
+    backend2 = Server("localhost:8082")
+    pool = ServerPool([backend1, backend2])
+    assert pool.healthy == [backend1, backend2]
+    backend1.healthy = False
+    assert pool.healthy == [backend2]
+    healthy = pool.healthy
+    backend1.healthy = False
+    assert pool.healthy is healthy
+    backend1.healthy = True
+    assert pool.healthy == [backend1, backend2]
+
+
+def test_server_pool_add_remove():
+    backend1 = Server("localhost:8081")
+    backend2 = Server("localhost:8082")
+    pool = ServerPool([backend1])
+    pool.add(backend2)
+    assert list(pool) == [backend1, backend2]
+    assert pool.healthy == [backend1, backend2]
+    pool.remove(backend1)
+    assert list(pool) == [backend2]
+    assert pool.healthy == [backend2]
+    assert backend1.pools == []
+    backend1.healthy = False
+    assert pool.healthy == [backend2]
+
+
+def test_server_pool_batches_refresh(monkeypatch):
+    refreshes = []
+    monkeypatch.setattr(ServerPool, "refresh", lambda pool: refreshes.append(pool))
+    servers = [Server(f"localhost:{port}") for port in range(8081, 8181)]
+    pool = ServerPool(servers)
+    pool.remove(*servers[:50])
+    assert len(pool) == 50
+    assert len(refreshes) == 2
+
+
+def test_server_healthy_since_resets_on_recovery():
+    server = Server("localhost:8081")
+    pool = ServerPool([server])
+    server.healthy = False
+    assert pool.newest is None
+    recovered = time.monotonic()
+    server.healthy = True
+    assert server.healthy_since >= recovered
+    assert pool.newest == server.healthy_since
+
+
+def test_server_pool_health_transitions_do_not_interleave(monkeypatch):
+    a = Server("localhost:8081")
+    b = Server("localhost:8082")
+    pool = ServerPool([a, b])
+    computing = threading.Event()
+    preferred = ServerPool.preferred
+
+    def slow_preferred(pool, available):
+        # hold the first rebuild back after it has read the old state
+        result = preferred(pool, available)
+        if not computing.is_set():
+            computing.set()
+            time.sleep(0.1)
+        return result
+
+    monkeypatch.setattr(ServerPool, "preferred", slow_preferred)
+    down = threading.Thread(target=setattr, args=(a, "healthy", False))
+    down.start()
+    computing.wait(5)
+    up = threading.Thread(target=setattr, args=(a, "healthy", True))
+    up.start()
+    down.join()
+    up.join()
+    assert a.healthy
+    assert pool.healthy == [a, b]
+
+
+def test_server_pool_excludes_draining():
+    backend1 = Server("localhost:8081")
+    backend2 = Server("localhost:8082")
+    pool = ServerPool([backend1, backend2])
+    backend1.drain()
+    assert pool.healthy == [backend2]
+    assert list(pool) == [backend1, backend2]
+    assert pool.find("localhost:8081") is backend1
+    assert pool.find("localhost:8083") is None
+
+
+def test_server_pool_priority_tiers():
+    primary1 = Server("localhost:8081")
+    primary2 = Server("localhost:8082")
+    backup = Server("localhost:8083", priority=1)
+    pool = ServerPool([primary1, primary2, backup], threshold=0.5)
+    assert pool.healthy == [primary1, primary2]
+    primary1.healthy = False
+    assert pool.healthy == [primary2]
+    primary2.healthy = False
+    assert pool.healthy == [backup]
+    primary1.healthy = True
+    assert pool.healthy == [primary1]
+
+
+def test_server_pool_spills_over_below_threshold():
+    primary1 = Server("localhost:8081")
+    primary2 = Server("localhost:8082")
+    backup = Server("localhost:8083", priority=1)
+    pool = ServerPool([primary1, primary2, backup], threshold=1.0)
+    primary1.healthy = False
+    assert pool.healthy == [primary2, backup]
+
+
+def test_server_pool_prefers_local_zone():
+    local1 = Server("localhost:8081", zone="rack-a")
+    local2 = Server("localhost:8082", zone="rack-a")
+    remote = Server("localhost:8083", zone="rack-b")
+    pool = ServerPool([local1, remote, local2], zone="rack-a", threshold=0.5)
+    assert pool.healthy == [local1, local2]
+    local1.healthy = False
+    assert pool.healthy == [local2]
+    local2.healthy = False
+    assert pool.healthy == [remote]
+
+
+def test_server_pool_zone_within_tier():
+    local_backup = Server("localhost:8081", zone="rack-a", priority=1)
+    remote = Server("localhost:8082", zone="rack-b")
+    pool = ServerPool([local_backup, remote], zone="rack-a")
+    assert pool.healthy == [remote]
+
+
+def test_server_pool_local_backup_does_not_replace_remote_primaries():
+    primaries = [Server(f"localhost:808{port}", zone="rack-b") for port in (1, 2, 3)]
+    local_backup = Server("localhost:8084", zone="rack-a", priority=1)
+    pool = ServerPool(primaries + [local_backup], zone="rack-a", threshold=0.7)
+    assert pool.healthy == primaries
+    primaries[0].healthy = False
+    assert pool.healthy == [primaries[1], primaries[2], local_backup]
+
+
+def test_server_pool_zero_threshold_still_fails_over():
+    primary = Server("localhost:8081")
+    backup = Server("localhost:8082", priority=1)
+    pool = ServerPool([primary, backup], threshold=0)
+    assert pool.healthy == [primary]
+    primary.healthy = False
+    assert pool.healthy == [backup]
+
+
+def test_server_pool_spills_over_several_tiers():
+    tier0 = [Server("localhost:8081"), Server("localhost:8082")]
+    tier1 = [Server("localhost:8083", priority=1)]
+    tier2 = [Server("localhost:8084", priority=2), Server("localhost:8085", priority=2)]
+    pool = ServerPool(tier0 + tier1 + tier2, threshold=0.75)
+    tier0[0].healthy = False
+    # 1 of 2, then 2 of 3 healthy so far, both short of the threshold
+    assert pool.healthy == [tier0[1], tier1[0], tier2[0], tier2[1]]
+    tier2[1].healthy = False
+    assert pool.healthy == [tier0[1], tier1[0], tier2[0]]
+    tier0[0].healthy = True
+    assert pool.healthy == tier0
+
+
+@pytest.fixture
+def selector():
+    groups = [
+        {"name": "stable", "servers": ["localhost:8081"]},
+        {"name": "canary", "servers": ["localhost:8082"]},
+    ]
+    match = [
+        {"header": "X-Internal-User", "value": "true", "group": "canary"},
+        {"cookie": "canary", "group": "canary"},
+    ]
+    yield GroupSelector(groups, {"stable": 90, "canary": 10}, match)
+
+
+def test_group_selector_header_match(selector):
+    group = selector.select({"X-Internal-User": "true"}, {})
+    assert group["name"] == "canary"
+
+
+def test_group_selector_cookie_match(selector):
+    assert selector.select({}, {"canary": "anything"})["name"] == "canary"
+
+
+def test_group_selector_split(selector, monkeypatch):
+    monkeypatch.setattr("random.random", lambda: 0.5)
+    assert selector.select({"X-Internal-User": "false"}, {})["name"] == "stable"
+    monkeypatch.setattr("random.random", lambda: 0.95)
+    assert selector.select({}, {})["name"] == "canary"
+
+
+def test_group_selector_default_split():
+    selector = GroupSelector([{"name": "stable"}, {"name": "canary"}])
+    assert {selector.select({}, {})["name"] for _ in range(20)} == {"stable"}
+
+
+def test_dropping_queue_drops_when_full():
+    items = DroppingQueue(1)
+    items.offer("first")
+    items.offer("second")
+    assert items.dropped == 1
+    assert items.get_nowait() == "first"
@@ -0,0 +1,68 @@
+import threading
+import time
+
+from profiling import Histogram, SamplingProfiler, StageProfiler
+
+
+def test_histogram_observe():
+    histogram = Histogram(buckets=[0.1, 1.0])
+    histogram.observe(0.05)
+    histogram.observe(0.5)
+    histogram.observe(5.0)
+    assert histogram.counts == [1, 1, 1]
+    assert histogram.count == 3
+    assert histogram.total == 5.55
+
+
+def test_histogram_quantile():
+    histogram = Histogram(buckets=[0.1, 1.0])
+    assert histogram.quantile(0.5) is None
+    for value in [0.05, 0.05, 0.05, 0.5]:
+        histogram.observe(value)
+    assert histogram.quantile(0.5) == 0.1
+    assert histogram.quantile(0.99) == 1.0
+
+
+def test_stage_profiler_disabled():
+    profiler = StageProfiler()
+    with profiler.stage("healthcheck"):
+        pass
+    assert profiler.to_dict() == {}
+
+
+def test_stage_profiler_enabled():
+    profiler = StageProfiler(enabled=True)
+    with profiler.stage("healthcheck"):
+        pass
+    with profiler.stage("healthcheck"):
+        pass
+    with profiler.stage("upstream"):
+        pass
+    stages = profiler.to_dict()
+    assert stages["healthcheck"]["count"] == 2
+    assert stages["upstream"]["count"] == 1
+    profiler.reset()
+    assert profiler.to_dict() == {}
+
+
+def busy_backend(stop):
+    while not stop.is_set():
+        time.sleep(0.001)
+
+
+def test_sampling_profiler_folded_stacks():
+    stop = threading.Event()
+    worker = threading.Thread(target=busy_backend, args=(stop,))
+    worker.start()
+    sampler = SamplingProfiler(interval=0.001)
+    assert sampler.start(0.05)
+    assert not sampler.start(0.05)
+    time.sleep(0.05)
+    sampler.stop()
+    stop.set()
+    worker.join()
+    lines = sampler.folded().splitlines()
+    assert any("busy_backend" in line for line in lines)
+    stack, count = lines[0].rsplit(" ", 1)
+    assert int(count) > 0
+    assert ";" in stack
@@ -0,0 +1,129 @@
+import socket
+import threading
+
+import requests
+import responses
+
+from models import Server
+from proxy import (host_and_port, is_event_stream, is_upgrade, splice, stream,
+                   tunnel, upgrade_request)
+from serving import InFlight
+
+
+def test_is_upgrade():
+    assert is_upgrade({"Connection": "keep-alive, Upgrade", "Upgrade": "websocket"})
+    assert not is_upgrade({"Connection": "keep-alive"})
+    assert not is_upgrade({"Connection": "Upgrade"})
+
+
+def test_is_event_stream():
+    assert is_event_stream({"Accept": "text/event-stream"})
+    assert not is_event_stream({"Accept": "application/json"})
+    assert not is_event_stream({})
+
+
+def test_host_and_port():
+    assert host_and_port("localhost:8081", 80) == ("localhost", 8081)
+    assert host_and_port("api.example.com", 443) == ("api.example.com", 443)
+    assert host_and_port("[::1]:8443", 443) == ("::1", 8443)
+
+
+def test_upgrade_request():
+    server = Server("localhost:8081")
+    result = upgrade_request(
+        server, "/chat?room=1", {"Connection": "Upgrade", "Upgrade": "websocket"}
+    )
+    assert result == (
+        b"GET /chat?room=1 HTTP/1.1\r\n"
+        b"Connection: Upgrade\r\n"
+        b"Upgrade: websocket\r\n"
+        b"Host: localhost:8081\r\n\r\n"
+    )
+
+
+def test_splice():
+    client, client_proxy = socket.socketpair()
+    upstream_proxy, upstream = socket.socketpair()
+    result = []
+    thread = threading.Thread(
+        target=lambda: result.append(splice(client_proxy, upstream_proxy, 5))
+    )
+    thread.start()
+    client.sendall(b"ping")
+    assert upstream.recv(4) == b"ping"
+    upstream.sendall(b"pong")
+    assert client.recv(4) == b"pong"
+    client.close()
+    thread.join()
+    assert result == ["closed"]
+
+
+def test_splice_idle_timeout():
+    client, client_proxy = socket.socketpair()
+    upstream_proxy, upstream = socket.socketpair()
+    assert splice(client_proxy, upstream_proxy, 0.05) == "idle"
+
+
+def test_tunnel_counts_open_connections():
+    listener = socket.socket()
+    listener.bind(("127.0.0.1", 0))
+    listener.listen()
+    server = Server(f"127.0.0.1:{listener.getsockname()[1]}")
+    client, client_proxy = socket.socketpair()
+    result = []
+    thread = threading.Thread(
+        target=lambda: result.append(
+            tunnel(server, client_proxy, "/ws", {"Upgrade": "websocket"}, 5)
+        )
+    )
+    thread.start()
+    backend, _ = listener.accept()
+    assert backend.recv(1024).startswith(b"GET /ws HTTP/1.1\r\n")
+    backend.sendall(b"HTTP/1.1 101 Switching Protocols\r\n\r\n")
+    assert client.recv(1024) == b"HTTP/1.1 101 Switching Protocols\r\n\r\n"
+    assert server.open_connections == 1
+    backend.close()
+    thread.join()
+    assert server.open_connections == 0
+    assert result[0].status_code == 101
+    listener.close()
+
+
+def test_tunnel_bad_gateway():
+    listener = socket.socket()
+    listener.bind(("127.0.0.1", 0))
+    server = Server(f"127.0.0.1:{listener.getsockname()[1]}")
+    listener.close()
+    client, client_proxy = socket.socketpair()
+    assert tunnel(server, client_proxy, "/", {}, 1) == ("Bad Gateway", 502)
+    assert server.open_connections == 0
+
+
+@responses.activate
+def test_stream_counts_open_connections():
+    responses.add(
+        responses.GET,
+        "http://localhost:8081/",
+        body="data: hello\n\n",
+        content_type="text/event-stream",
+    )
+    server = Server("localhost:8081")
+    response = requests.get(server.url(), stream=True)
+    proxied = stream(server, response)
+    assert server.open_connections == 1
+    assert b"".join(proxied.response) == b"data: hello\n\n"
+    assert proxied.mimetype == "text/event-stream"
+    proxied.close()
+    assert server.open_connections == 0
+
+
+@responses.activate
+def test_stream_counts_as_in_flight():
+    responses.add(responses.GET, "http://localhost:8081/", body="data: hello\n\n")
+    server = Server("localhost:8081")
+    in_flight = InFlight()
+    proxied = stream(server, requests.get(server.url(), stream=True), in_flight)
+    # a drain waits for the open stream, not just for the request handler
+    assert not in_flight.wait(0.01)
+    proxied.close()
+    assert in_flight.wait(0)
@@ -0,0 +1,92 @@
+import os
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import requests
+
+from serving import InFlight
+
+APP = """
+import os
+import sys
+
+from flask import Flask
+
+from serving import InFlight, serve
+
+app = Flask(__name__)
+
+
+@app.route("/")
+def pid():
+    return str(os.getpid())
+
+
+serve(app, "127.0.0.1", int(sys.argv[1]), InFlight(), drain_timeout=1)
+"""
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_pid(port, exclude=None):
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            pid = int(requests.get(f"http://127.0.0.1:{port}/", timeout=1).text)
+            if pid != exclude:
+                return pid
+        except requests.exceptions.ConnectionError:
+            pass
+        time.sleep(0.05)
+    raise AssertionError("nothing answered on the port")
+
+
+def test_in_flight_wait_idle():
+    in_flight = InFlight()
+    assert in_flight.wait(0)
+
+
+def test_in_flight_wait_times_out():
+    in_flight = InFlight()
+    in_flight.enter()
+    assert not in_flight.wait(0.01)
+    assert in_flight.count == 1
+
+
+def test_in_flight_wait_for_requests():
+    in_flight = InFlight()
+    in_flight.enter()
+    in_flight.enter()
+    timer = threading.Timer(0.01, lambda: (in_flight.exit(), in_flight.exit()))
+    timer.start()
+    assert in_flight.wait(5)
+    assert in_flight.count == 0
+
+
+def test_serve_hands_listener_to_new_process(tmp_path):
+    script = tmp_path / "app.py"
+    script.write_text(APP)
+    port = free_port()
+    here = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, PYTHONPATH=here)
+    old = subprocess.Popen([sys.executable, str(script), str(port)], env=env)
+    new_pid = None
+    try:
+        assert wait_for_pid(port) == old.pid
+        old.send_signal(signal.SIGUSR2)
+        new_pid = wait_for_pid(port, exclude=old.pid)
+        assert old.wait(10) == 0
+        # the replacement keeps answering on the same port once the old is gone
+        assert wait_for_pid(port) == new_pid
+    finally:
+        old.kill()
+        if new_pid:
+            os.kill(new_pid, signal.SIGTERM)
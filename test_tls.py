@@ -0,0 +1,137 @@
+import shutil
+import socket
+import ssl
+import subprocess
+import threading
+
+import pytest
+import yaml
+
+from tls import CertificateStore, client_context
+
+pytestmark = pytest.mark.skipif(not shutil.which("openssl"), reason="needs openssl")
+
+
+def make_certificate(directory, name):
+    certfile = directory / f"{name}.pem"
+    keyfile = directory / f"{name}.key"
+    subprocess.run(
+        [
+            "openssl",
+            "req",
+            "-x509",
+            "-newkey",
+            "rsa:2048",
+            "-nodes",
+            "-days",
+            "1",
+            "-subj",
+            f"/CN={name}",
+            "-addext",
+            f"subjectAltName=DNS:{name}",
+            "-keyout",
+            str(keyfile),
+            "-out",
+            str(certfile),
+        ],
+        check=True,
+        capture_output=True,
+    )
+    return str(certfile), str(keyfile)
+
+
+def serve(context, connections):
+    listener = socket.socket()
+    listener.bind(("127.0.0.1", 0))
+    listener.listen()
+
+    def accept():
+        for _ in range(connections):
+            conn, _ = listener.accept()
+            with context.wrap_socket(conn, server_side=True) as tls_conn:
+                tls_conn.sendall(b"ok")
+                tls_conn.recv(1)
+        listener.close()
+
+    thread = threading.Thread(target=accept, daemon=True)
+    thread.start()
+    return listener.getsockname()[1]
+
+
+def peer_subject(port, server_name):
+    context = ssl.create_default_context()
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    with socket.create_connection(("127.0.0.1", port)) as sock:
+        with context.wrap_socket(sock, server_hostname=server_name) as tls_sock:
+            tls_sock.recv(2)
+            der = tls_sock.getpeercert(binary_form=True)
+    return ssl.DER_cert_to_PEM_cert(der)
+
+
+def pem(certfile):
+    with open(certfile) as cert:
+        return ssl.DER_cert_to_PEM_cert(ssl.PEM_cert_to_DER_cert(cert.read()))
+
+
+def test_certificate_store_from_config(tmp_path):
+    anthrax = make_certificate(tmp_path, "www.anthrax.com")
+    config = yaml.safe_load(f"""
+        hosts:
+          - host: www.anthrax.com
+            tls:
+              cert: {anthrax[0]}
+              key: {anthrax[1]}
+            servers:
+              - localhost:8081
+          - host: www.slayer.com
+            servers:
+              - localhost:1111
+    """)
+    store = CertificateStore.from_config(config)
+    assert list(store.contexts) == ["www.anthrax.com"]
+    assert store.context_for("www.slayer.com") is store.default
+
+
+def test_certificate_store_without_tls():
+    assert CertificateStore.from_config({"hosts": []}) is None
+
+
+def test_sni_certificate_selection(tmp_path):
+    anthrax = make_certificate(tmp_path, "www.anthrax.com")
+    metallica = make_certificate(tmp_path, "www.metallica.com")
+    store = CertificateStore(
+        {"www.anthrax.com": anthrax, "www.metallica.com": metallica}
+    )
+    port = serve(store.server_context(), 2)
+    assert peer_subject(port, "www.metallica.com") == pem(metallica[0])
+    assert peer_subject(port, "www.anthrax.com") == pem(anthrax[0])
+
+
+def test_certificate_reload(tmp_path):
+    anthrax = make_certificate(tmp_path, "www.anthrax.com")
+    store = CertificateStore({"www.anthrax.com": anthrax})
+    port = serve(store.server_context(), 2)
+    before = peer_subject(port, "www.anthrax.com")
+    make_certificate(tmp_path, "www.anthrax.com")
+    store.reload()
+    after = peer_subject(port, "www.anthrax.com")
+    assert before != after
+    assert after == pem(anthrax[0])
+
+
+def test_client_session_resumption(tmp_path):
+    certfile, keyfile = make_certificate(tmp_path, "localhost")
+    server_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    server_context.load_cert_chain(certfile, keyfile)
+    port = serve(server_context, 2)
+    context = client_context(verify=certfile)
+    reused = []
+    for _ in range(2):
+        sock = socket.create_connection(("127.0.0.1", port))
+        tls_sock = context.wrap_socket(sock, server_hostname="localhost")
+        tls_sock.recv(2)
+        reused.append(tls_sock.session_reused)
+        tls_sock.sendall(b"x")
+        tls_sock.close()
+    assert reused == [False, True]
@@ -1,11 +1,15 @@
 import pickle
+import threading
 
 import yaml
 
-from models import Server
-from utils import (get_healthy_server, healthcheck, least_connections,
-                   process_firewall_rules_flag, process_rewrite_rules,
-                   process_rules, transform_backends_from_config, weighted)
+from models import Server, ServerPool
+from utils import (apply_rewrite_rules, apply_rules, drain_server,
+                   firewall_allows, get_healthy_server, group_key, healthcheck,
+                   least_connections, process_firewall_rules_flag,
+                   process_rewrite_rules, process_rules, selectors_from_config,
+                   server_from_config, slow_start_factor, slow_start_factors,
+                   transform_backends_from_config, weighted)
 
 
 def test_transform_backends_from_config():
@@ -48,6 +52,86 @@ def test_transform_backends_from_config():
     assert output["/metallica"][1] == Server("localhost:9082")
 
 
+def test_transform_backends_from_config_groups():
+    input = yaml.safe_load(
+        """
+        hosts:
+          - host: www.megadeth.com
+            groups:
+              - name: stable
+                algo: round
+                servers:
+                  - localhost:8081
+                  - localhost:8082
+              - name: canary
+                servers:
+                  - localhost:8083
+            split:
+              stable: 95
+              canary: 5
+            match:
+              - header: X-Internal-User
+                group: canary
+    """
+    )
+    output = transform_backends_from_config(input)
+    assert list(output.keys()) == [
+        "www.megadeth.com",
+        "www.megadeth.com#stable",
+        "www.megadeth.com#canary",
+    ]
+    assert list(output[group_key("www.megadeth.com", "canary")]) == [
+        Server("localhost:8083")
+    ]
+    selectors = selectors_from_config(input)
+    group = selectors["www.megadeth.com"].select({"X-Internal-User": "yes"}, {})
+    assert group["name"] == "canary"
+
+
+def test_server_from_config():
+    server = server_from_config("localhost:8081")
+    assert server.url() == "http://localhost:8081/"
+    server = server_from_config("https://localhost:8443")
+    assert server.url() == "https://localhost:8443/"
+    server = server_from_config(
+        {"endpoint": "localhost:8443", "scheme": "https", "verify": False}
+    )
+    assert server.url() == "https://localhost:8443/"
+    assert server.session.verify is False
+    server = server_from_config(
+        {"endpoint": "localhost:8081", "zone": "rack-a", "priority": 1}
+    )
+    assert server.zone == "rack-a"
+    assert server.priority == 1
+
+
+def test_transform_backends_from_config_locality(monkeypatch):
+    input = yaml.safe_load(
+        """
+        zone: rack-a
+        hosts:
+          - host: www.anthrax.com
+            failover:
+              threshold: 0.5
+            servers:
+              - endpoint: localhost:8081
+                zone: rack-a
+              - endpoint: localhost:8082
+                zone: rack-b
+              - endpoint: localhost:8083
+                zone: rack-a
+                priority: 1
+    """
+    )
+    output = transform_backends_from_config(input)
+    assert output["www.anthrax.com"].zone == "rack-a"
+    assert output["www.anthrax.com"].threshold == 0.5
+    assert output["www.anthrax.com"].healthy == [Server("localhost:8081")]
+    monkeypatch.setenv("LOADBALANCER_ZONE", "rack-b")
+    output = transform_backends_from_config(input)
+    assert output["www.anthrax.com"].healthy == [Server("localhost:8082")]
+
+
 def test_get_healthy_server():
     healthy_server = Server("localhost:8081")
     unhealthy_server = Server("localhost:8082")
@@ -66,6 +150,106 @@ def test_get_healthy_server():
     assert get_healthy_server("/metallica", register) is None
 
 
+def test_get_healthy_server_pool():
+    healthy_server = Server("localhost:8081")
+    unhealthy_server = Server("localhost:8082")
+    register = {"www.anthrax.com": ServerPool([healthy_server, unhealthy_server])}
+    unhealthy_server.healthy = False
+    assert get_healthy_server("www.anthrax.com", register) == healthy_server
+    assert get_healthy_server("www.anthrax.com", register, "least") == healthy_server
+    healthy_server.healthy = False
+    assert get_healthy_server("www.anthrax.com", register) is None
+
+
+def test_slow_start_factor():
+    server = Server("localhost:8081")
+    now = server.healthy_since
+    linear = {"window": 10, "floor": 0.1}
+    assert slow_start_factor(server, linear, now) == 0.1
+    assert slow_start_factor(server, linear, now + 5) == 0.55
+    assert slow_start_factor(server, linear, now + 10) == 1.0
+    exponential = {"window": 10, "floor": 0.01, "mode": "exponential"}
+    assert slow_start_factor(server, exponential, now) == 0.01
+    assert round(slow_start_factor(server, exponential, now + 5), 6) == 0.1
+    assert slow_start_factor(server, exponential, now + 20) == 1.0
+
+
+def test_slow_start_factors_relative():
+    warm = Server("localhost:8081")
+    warm.healthy_since -= 60
+    cold = Server("localhost:8082")
+    factors = slow_start_factors([warm, cold], {"window": 30, "floor": 0.5})
+    assert factors[0] == 1.0
+    assert 0.5 <= factors[1] < 0.6
+    assert slow_start_factors([warm], {"window": 30}) is None
+    assert slow_start_factors([warm, cold], None) is None
+
+
+def test_get_healthy_server_slow_start():
+    warm = Server("localhost:8081")
+    warm.healthy_since -= 60
+    cold = Server("localhost:8082")
+    register = {"www.anthrax.com": ServerPool([cold, warm])}
+    slow_start = {"window": 1000, "floor": 0}
+    pickle.dump({"server": warm.endpoint}, open("last.p", "wb"))
+    for algo in [None, "least", "round"]:
+        for _ in range(10):
+            server = get_healthy_server(
+                "www.anthrax.com", register, algo, slow_start=slow_start
+            )
+            assert server is warm
+    server = get_healthy_server(
+        "www.anthrax.com", register, "weight", [5, 5], slow_start
+    )
+    assert server is warm
+    # too few weights is a 503 like it is without slow start, not a crash
+    server = get_healthy_server("www.anthrax.com", register, "weight", [5], slow_start)
+    assert server is None
+
+
+def test_slow_start_round_robin_reads_last_once(monkeypatch):
+    servers = [Server(f"localhost:{port}") for port in range(8081, 8085)]
+    for server in servers[1:]:
+        server.healthy_since -= 60
+    register = {"www.anthrax.com": ServerPool(servers)}
+    pickle.dump({"server": "localhost:8084"}, open("last.p", "wb"))
+    loads = []
+    load = pickle.load
+    monkeypatch.setattr(pickle, "load", lambda file: loads.append(file) or load(file))
+    slow_start = {"window": 1000, "floor": 0}
+    server = get_healthy_server("www.anthrax.com", register, "round", None, slow_start)
+    # the cold first server is skipped on the way to the next warm one
+    assert server is servers[1]
+    assert len(loads) == 1
+    assert load(open("last.p", "rb")) == {"server": "localhost:8082"}
+
+
+def test_drain_server_waits_for_connections():
+    draining = Server("localhost:8081")
+    draining.open_connections = 1
+    pool = ServerPool([draining, Server("localhost:8082")])
+    threading.Timer(0.05, lambda: setattr(draining, "open_connections", 0)).start()
+    drain_server(pool, draining, timeout=5, interval=0.01)
+    assert list(pool) == [Server("localhost:8082")]
+    assert draining.open_connections == 0
+
+
+def test_drain_server_twice():
+    draining = Server("localhost:8081")
+    pool = ServerPool([draining, Server("localhost:8082")])
+    drain_server(pool, draining, timeout=0)
+    drain_server(pool, draining, timeout=0)
+    assert list(pool) == [Server("localhost:8082")]
+
+
+def test_drain_server_timeout():
+    draining = Server("localhost:8081")
+    draining.open_connections = 1
+    pool = ServerPool([draining])
+    drain_server(pool, draining, timeout=0.01, interval=0.01)
+    assert list(pool) == []
+
+
 def test_healthcheck():
     config = yaml.safe_load(
         """
@@ -473,3 +657,27 @@ def test_process_firewall_header_rules_accept():
         input, "www.anthrax.com", headers={"User-Agent": "Safe App"}
     )
     assert results is True
+
+
+def test_rules_for_looked_up_entry():
+    entry = yaml.safe_load(
+        """
+        host: www.anthrax.com
+        header_rules:
+          add:
+            MyCustomHeader: Test
+          remove:
+            Host: www.anthrax.com
+        rewrite_rules:
+          replace:
+            v1: v2
+        firewall_rules:
+          ip_reject:
+            - 10.192.0.1
+    """
+    )
+    headers = apply_rules(entry, {"Host": "www.anthrax.com"}, "header")
+    assert headers == {"MyCustomHeader": "Test"}
+    assert apply_rewrite_rules(entry, "v1") == "v2"
+    assert not firewall_allows(entry, "10.192.0.1")
+    assert firewall_allows(entry, "55.55.55.55")
@@ -0,0 +1,126 @@
+import ssl
+import threading
+import weakref
+
+from requests.adapters import HTTPAdapter
+
+
+class ResumingSocket(ssl.SSLSocket):
+    def close(self):
+        # keep the session, including tickets received since the handshake
+        if self._sslobj is not None and self.session is not None:
+            self.context._remember(self.server_hostname, self.session)
+        super().close()
+
+
+class ResumingContext(ssl.SSLContext):
+    # remember the last TLS session per upstream so new pooled connections
+    # resume it instead of paying for a full handshake
+    sslsocket_class = ResumingSocket
+
+    def __init__(self, *args, **kwargs):
+        super().__init__()
+        self._sessions = {}
+        self._sockets = {}
+        self._lock = threading.Lock()
+
+    def wrap_socket(self, sock, *args, server_hostname=None, session=None, **kwargs):
+        if session is None:
+            session = self._latest_session(server_hostname)
+        tls_sock = super().wrap_socket(
+            sock, *args, server_hostname=server_hostname, session=session, **kwargs
+        )
+        with self._lock:
+            self._sockets[server_hostname] = weakref.ref(tls_sock)
+            if tls_sock.session is not None:
+                self._sessions[server_hostname] = tls_sock.session
+        return tls_sock
+
+    def _remember(self, server_hostname, session):
+        with self._lock:
+            self._sessions[server_hostname] = session
+
+    def _latest_session(self, server_hostname):
+        with self._lock:
+            # TLS 1.3 tickets arrive after the handshake, so prefer the session
+            # of the live socket over the one captured when it was opened
+            ref = self._sockets.get(server_hostname)
+            tls_sock = ref() if ref else None
+            if tls_sock is not None and tls_sock.session is not None:
+                self._sessions[server_hostname] = tls_sock.session
+            return self._sessions.get(server_hostname)
+
+
+def client_context(verify=True):
+    context = ResumingContext(ssl.PROTOCOL_TLS_CLIENT)
+    if verify is False:
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    elif isinstance(verify, str):
+        context.load_verify_locations(cafile=verify)
+    else:
+        context.load_default_certs()
+    return context
+
+
+class TLSAdapter(HTTPAdapter):
+    def __init__(self, ssl_context, **kwargs):
+        self.ssl_context = ssl_context
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs["ssl_context"] = self.ssl_context
+        return super().init_poolmanager(*args, **kwargs)
+
+
+class CertificateStore:
+    def __init__(self, certificates, default=None):
+        # certificates maps a host name to a (certfile, keyfile) pair
+        self.certificates = certificates
+        self.default_certificate = default
+        self.contexts = {}
+        self.default = None
+        self.reload()
+
+    @classmethod
+    def from_config(cls, config):
+        certificates = {}
+        for entry in config.get("hosts", []):
+            if "tls" in entry:
+                tls = entry["tls"]
+                certificates[entry["host"]] = (tls["cert"], tls["key"])
+        default = config.get("tls")
+        if not certificates and not default:
+            return None
+        if default:
+            default = (default["cert"], default["key"])
+        return cls(certificates, default)
+
+    def reload(self):
+        contexts = {
+            host: self._load(certfile, keyfile)
+            for host, (certfile, keyfile) in self.certificates.items()
+        }
+        if self.default_certificate:
+            default = self._load(*self.default_certificate)
+        else:
+            default = next(iter(contexts.values()))
+        # swap both at once so a handshake never sees a half reloaded store
+        self.contexts, self.default = contexts, default
+
+    def server_context(self):
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.sni_callback = self._select
+        return context
+
+    def context_for(self, server_name):
+        return self.contexts.get(server_name, self.default)
+
+    def _select(self, sslsock, server_name, initial_context):
+        sslsock.context = self.context_for(server_name)
+
+    @staticmethod
+    def _load(certfile, keyfile):
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(certfile, keyfile)
+        return context
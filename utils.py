@@ -1,9 +1,11 @@
+import os
 import pickle
 import random
+import time
 
 import yaml
 
-from models import Server
+from models import GroupSelector, Server, ServerPool
 
 
 def load_configuration(path):
@@ -12,48 +14,159 @@ def load_configuration(path):
     return config
 
 
+def server_from_config(entry):
+    if isinstance(entry, str):
+        if "://" in entry:
+            scheme, endpoint = entry.split("://", 1)
+            return Server(endpoint, scheme=f"{scheme}://")
+        return Server(entry)
+    return Server(
+        entry["endpoint"],
+        scheme=f"{entry.get('scheme', 'http')}://",
+        verify=entry.get("verify", True),
+        zone=entry.get("zone"),
+        priority=entry.get("priority", 0),
+    )
+
+
+def pool_from_config(entry, zone=None):
+    servers = map(server_from_config, entry.get("servers", []))
+    threshold = entry.get("failover", {}).get("threshold", 0.7)
+    return ServerPool(servers, zone=zone, threshold=threshold)
+
+
+def group_key(host, group):
+    return f"{host}#{group}"
+
+
 def transform_backends_from_config(config):
     register = {}
+    # the zone this balancer runs in, the environment wins so one file can
+    # be shared between racks
+    zone = os.environ.get("LOADBALANCER_ZONE", config.get("zone"))
     for entry in config.get("hosts", []):
-        register.update(
-            {entry["host"]: [Server(endpoint) for endpoint in entry["servers"]]}
-        )
+        register.update({entry["host"]: pool_from_config(entry, zone)})
+        for group in entry.get("groups", []):
+            key = group_key(entry["host"], group["name"])
+            register.update({key: pool_from_config(group, zone)})
     for entry in config.get("paths", []):
-        register.update(
-            {entry["path"]: [Server(endpoint) for endpoint in entry["servers"]]}
-        )
+        register.update({entry["path"]: pool_from_config(entry, zone)})
     return register
 
 
-def get_healthy_server(host, register, algo=None, weights=None):
+def selectors_from_config(config):
+    return {
+        entry["host"]: GroupSelector(
+            entry["groups"], entry.get("split"), entry.get("match", [])
+        )
+        for entry in config.get("hosts", [])
+        if "groups" in entry
+    }
+
+
+def healthy_servers(servers):
+    # pools keep their healthy members up to date, plain lists are filtered
+    if isinstance(servers, ServerPool):
+        return servers.healthy
+    return [server for server in servers if server.healthy]
+
+
+def slow_start_factor(server, slow_start, now):
+    elapsed = now - server.healthy_since
+    window = slow_start.get("window", 30)
+    if elapsed >= window:
+        return 1.0
+    floor = slow_start.get("floor", 0.1)
+    progress = elapsed / window
+    if slow_start.get("mode") == "exponential":
+        return floor ** (1 - progress)
+    return floor + (1 - floor) * progress
+
+
+def slow_start_factors(servers, slow_start, newest=None):
+    # relative share of traffic for each server, or None when none is ramping
+    if not slow_start or not servers:
+        return None
+    now = time.monotonic()
+    if newest is None:
+        newest = max(server.healthy_since for server in servers)
+    if now - newest >= slow_start.get("window", 30):
+        return None
+    factors = [slow_start_factor(server, slow_start, now) for server in servers]
+    highest = max(factors)
+    return [factor / highest for factor in factors]
+
+
+def get_healthy_server(host, register, algo=None, weights=None, slow_start=None):
+    pool = register[host]
+    healthy = healthy_servers(pool)
+    newest = pool.newest if isinstance(pool, ServerPool) else None
+    factors = slow_start_factors(healthy, slow_start, newest)
+    if factors:
+        try:
+            return slow_start_server(healthy, factors, algo, weights)
+        except IndexError:
+            return None
     if algo == "least":
         try:
-            return least_connections(
-                [server for server in register[host] if server.healthy]
-            )
+            return least_connections(healthy)
         except IndexError:
             return None
     elif algo == "weight":
         try:
-            return weighted(
-                [server for server in register[host] if server.healthy], weights
-            )
+            return weighted(healthy, weights)
         except IndexError:
             return None
     elif algo == "round":
         try:
-            return round_robin([server for server in register[host] if server.healthy])
+            return round_robin(healthy)
         except IndexError:
             return None
     else:
         try:
-            return random.choice(
-                [server for server in register[host] if server.healthy]
-            )
+            return random.choice(healthy)
         except IndexError:
             return None
 
 
+def slow_start_server(servers, factors, algo=None, weights=None):
+    if algo == "least":
+        # fewer connections per unit of capacity wins
+        return min(
+            zip(servers, factors),
+            key=lambda pair: (pair[0].open_connections + 1) / pair[1],
+        )[0]
+    elif algo == "weight":
+        if not weights:
+            return None
+        weights = [weight * factor for weight, factor in zip(weights, factors)]
+        return weighted(servers, weights)
+    elif algo == "round":
+        # skip a ramping server in proportion to how cold it still is, walking
+        # the rotation in memory so last.p is read and written only once
+        endpoints = [server.endpoint for server in servers]
+        last_endpoint_called = pickle.load(open("last.p", "rb"))["server"]
+        start = 0
+        if last_endpoint_called in endpoints:
+            start = endpoints.index(last_endpoint_called) + 1
+        for offset in range(len(servers)):
+            index = (start + offset) % len(servers)
+            if random.random() < factors[index]:
+                break
+        pickle.dump({"server": endpoints[index]}, open("last.p", "wb"))
+        return servers[index]
+    else:
+        return random.choices(servers, weights=factors, k=1)[0]
+
+
+def drain_server(pool, server, timeout=30, interval=0.1):
+    server.drain()
+    deadline = time.monotonic() + timeout
+    while server.open_connections and time.monotonic() < deadline:
+        time.sleep(interval)
+    pool.remove(server)
+
+
 def healthcheck(register):
     for host in register:
         for server in register[host]:
@@ -62,31 +175,41 @@ def healthcheck(register):
 
 
 def process_rules(config, host, rules, modify):
+    for entry in config.get("hosts", []):
+        if host == entry["host"]:
+            apply_rules(entry, rules, modify)
+    return rules
+
+
+def apply_rules(entry, rules, modify):
+    # the same as process_rules for an entry the caller has already looked up
     modify_options = {
         "header": "header_rules",
         "param": "param_rules",
         "post_data": "post_data_rules",
         "cookie": "cookie_rules",
     }
-    for entry in config.get("hosts", []):
-        if host == entry["host"]:
-            header_rules = entry.get(modify_options[modify], {})
-            for instruction, modify_headers in header_rules.items():
-                if instruction == "add":
-                    rules.update(modify_headers)
-                if instruction == "remove":
-                    for key in modify_headers.keys():
-                        if key in rules:
-                            rules.pop(key)
+    header_rules = entry.get(modify_options[modify], {})
+    for instruction, modify_headers in header_rules.items():
+        if instruction == "add":
+            rules.update(modify_headers)
+        if instruction == "remove":
+            for key in modify_headers.keys():
+                if key in rules:
+                    rules.pop(key)
     return rules
 
 
 def process_rewrite_rules(config, host, path):
     for entry in config.get("hosts", []):
         if host == entry["host"]:
-            rewrite_rules = entry.get("rewrite_rules", {})
-            for current_path, new_path in rewrite_rules["replace"].items():
-                return path.replace(current_path, new_path)
+            return apply_rewrite_rules(entry, path)
+
+
+def apply_rewrite_rules(entry, path):
+    rewrite_rules = entry.get("rewrite_rules", {})
+    for current_path, new_path in rewrite_rules["replace"].items():
+        return path.replace(current_path, new_path)
 
 
 def least_connections(servers):
@@ -127,14 +250,20 @@ def round_robin(servers):
 def process_firewall_rules_flag(config, host, client_ip=None, path=None, headers=None):
     for entry in config.get("hosts", []):
         if host == entry["host"]:
-            firewall_rules = entry.get("firewall_rules", {})
-            if client_ip in firewall_rules.get("ip_reject", []):
+            if not firewall_allows(entry, client_ip, path, headers):
                 return False
-            if path in firewall_rules.get("path_reject", []):
+    return True
+
+
+def firewall_allows(entry, client_ip=None, path=None, headers=None):
+    firewall_rules = entry.get("firewall_rules", {})
+    if client_ip in firewall_rules.get("ip_reject", []):
+        return False
+    if path in firewall_rules.get("path_reject", []):
+        return False
+    if headers:
+        header_rules = firewall_rules.get("header_reject", {})
+        for key in headers:
+            if headers[key] in header_rules.get(key, {}):
                 return False
-            if headers:
-                header_rules = firewall_rules.get("header_reject", {})
-                for key in headers:
-                    if headers[key] in header_rules.get(key, {}):
-                        return False
     return True